@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+
+HOOKS = os.path.join(os.path.dirname(__file__), "..", "hooks")
+sys.path.append(HOOKS)
+
+from charmhelpers.core.hookenv import action_get, action_set  # noqa: E402
+
+from common import get_hook_timings  # noqa: E402
+
+timings = get_hook_timings()
+limit = action_get("limit")
+if limit:
+    timings = timings[-limit:]
+action_set(
+    {"timings": "\n".join(json.dumps(entry, sort_keys=True) for entry in timings)}
+)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+
+HOOKS = os.path.join(os.path.dirname(__file__), "..", "hooks")
+sys.path.append(HOOKS)
+
+from charmhelpers.core.hookenv import action_fail, action_get, action_set  # noqa: E402
+
+from status_dat import SERVICE_STATES, get_service_states  # noqa: E402
+
+states = {state.strip().upper() for state in action_get("states").split(",")}
+states.discard("")
+unknown_states = states.difference(SERVICE_STATES.values())
+if unknown_states:
+    action_fail("Unknown service states: {}".format(", ".join(sorted(unknown_states))))
+else:
+    try:
+        services = get_service_states(action_get("host") or None, states or None)
+    except OSError as e:
+        action_fail("Unable to read nagios status: {}".format(e))
+    else:
+        action_set(
+            {
+                "count": len(services),
+                "services": "\n".join(
+                    json.dumps(service, sort_keys=True) for service in services
+                ),
+            }
+        )
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+r"""nagios_perfdata.py - bulk processing of Nagios performance data files.
+
+Nagios appends the performance data of every check result to a spool file, and
+every processing interval its processing command renames the spool to
+<spool>.<epoch>.spool, so Nagios starts a fresh one.  Nagios waits for that
+command, which is why it only renames.  This script runs from cron and loads the
+renamed files into a SQLite store holding the latest value of each metric of
+each host and service: one transaction per file, rather than a fork per check.
+
+Spool lines are written by the host_perfdata_file_template and
+service_perfdata_file_template in nagios.cfg:
+
+    <epoch>\t<host name>\t<service description or empty>\t<state>\t<perfdata>
+"""
+
+import argparse
+import fcntl
+import glob
+import logging
+import logging.handlers
+import os
+import re
+import sqlite3
+import sys
+import traceback
+
+DEFAULT_STORE = "/var/lib/nagios4/perfdata.db"
+
+# label=value[UOM];[warn];[crit];[min];[max], where the label may be quoted and
+# then contain spaces, with quotes in it doubled
+PERFDATA_RE = re.compile(r"(?:'((?:[^']|'')+)'|([^\s=']+))=(\S*)")
+VALUE_RE = re.compile(r"^([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(\S*)$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS perfdata (
+    host TEXT NOT NULL,
+    service TEXT NOT NULL,
+    label TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    state TEXT,
+    value REAL,
+    uom TEXT,
+    warn TEXT,
+    crit TEXT,
+    min REAL,
+    max REAL,
+    PRIMARY KEY (host, service, label)
+) WITHOUT ROWID
+"""
+
+
+def main():
+    args = parse_args()
+    configure_logging(args.verbose)
+    try:
+        for perfdata_file in args.perfdata_file:
+            process(perfdata_file, args.store)
+    except Exception:
+        logging.error(traceback.format_exc())
+        return 1
+    return 0
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description="Load the Nagios performance data spool files moved aside by "
+        "the processing commands into a SQLite store of the latest value of each "
+        "metric."
+    )
+    ap.add_argument(
+        "perfdata_file",
+        nargs="+",
+        help="The host_perfdata_file or service_perfdata_file whose spool "
+        "files to load.",
+    )
+    ap.add_argument(
+        "-s",
+        "--store",
+        default=DEFAULT_STORE,
+        help="Path of the SQLite store.  Default: %(default)s",
+    )
+    ap.add_argument("-v", "--verbose", default=False, action="store_true")
+    return ap.parse_args()
+
+
+def configure_logging(verbose):
+    handlers = [
+        logging.handlers.SysLogHandler(
+            address="/dev/log",
+            facility=logging.handlers.SysLogHandler.LOG_LOCAL0,
+        ),
+    ]
+    if verbose:
+        handlers.append(logging.StreamHandler(stream=sys.stdout))
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(filename)s[%(levelname)s][%(process)s] %(message)s",
+        handlers=handlers,
+    )
+
+
+def process(perfdata_file, store):
+    """Load every spool file moved aside from ``perfdata_file`` into the store.
+
+    Files are removed once loaded, so those left by an interrupted run are
+    picked up by the next one.
+    """
+    with open(store + ".lock", "w") as lockfile:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        connection = sqlite3.connect(store)
+        try:
+            connection.execute(SCHEMA)
+            for path in sorted(glob.glob(glob.escape(perfdata_file) + ".*.spool")):
+                with connection:
+                    rows = connection.executemany(
+                        "INSERT OR REPLACE INTO perfdata VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        read_spool(path),
+                    ).rowcount
+                os.unlink(path)
+                logging.info("Loaded %d metrics from %s", rows, path)
+        finally:
+            connection.close()
+
+
+def read_spool(path):
+    """Yield a store row for each metric in a spool file."""
+    with open(path, errors="replace") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t", 4)
+            if len(fields) != 5:
+                continue
+            timestamp, host, service, state, perfdata = fields
+            try:
+                timestamp = int(timestamp)
+            except ValueError:
+                continue
+            for metric in parse_perfdata(perfdata):
+                yield (host, service, metric[0], timestamp, state) + metric[1:]
+
+
+def parse_perfdata(perfdata):
+    """Parse plugin performance data into (label, value, uom, warn, crit, min, max).
+
+    Metrics whose value isn't a number, such as "U" for unknown, are skipped.
+    """
+    metrics = []
+    for match in PERFDATA_RE.finditer(perfdata):
+        quoted, label, data = match.groups()
+        label = quoted.replace("''", "'") if quoted else label
+        value, warn, crit, minimum, maximum = (data.split(";") + [""] * 4)[:5]
+        value_match = VALUE_RE.match(value)
+        if not value_match:
+            continue
+        metrics.append(
+            (
+                label,
+                float(value_match.group(1)),
+                value_match.group(2),
+                warn or None,
+                crit or None,
+                _to_float(minimum),
+                _to_float(maximum),
+            )
+        )
+    return metrics
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+if __name__ == "__main__":
+    sys.exit(main())
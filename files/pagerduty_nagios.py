@@ -45,40 +45,85 @@ Help strings are mostly just copied from the Perl version of the script.
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-import argparse
+# Nagios runs this script for every notification, so only what enqueueing needs
+# is imported here; the HTTP stack, logging and argparse are imported by the
+# functions that flush the queue.
+import contextlib
 import fcntl
-import logging
-import logging.handlers
 import os
-import re
+import sqlite3
 import sys
 import time
-import traceback
-from urllib.error import HTTPError
-from urllib.parse import urlencode
-from urllib.request import Request, urlopen
+from collections import namedtuple
+from types import SimpleNamespace
 
 TIMEOUT_S = 10
+DEFAULT_API_BASE = "https://events.pagerduty.com/nagios/2010-04-15"
+DEFAULT_QUEUE_DIR = "/tmp/pagerduty_nagios"
+QUEUE_DB = "queue.db"
+# Number of queued events sent per round of a flush
+FLUSH_BATCH_SIZE = 1000
+# Events are sent concurrently over this many keep-alive connections
+DEFAULT_WORKERS = 4
+# Attempts per event before it is left in the queue for the next flush
+DEFAULT_MAX_ATTEMPTS = 3
+# Back-off after a failure or throttling, doubling with each one, with jitter
+RETRY_DELAY_S = 1
+MAX_RETRY_DELAY_S = 300
+# PagerDuty limits the events of each integration key to about 120 a minute
+DEFAULT_RATE = 2.0
+DEFAULT_BURST = 10
+# Events that would wait longer for their integration key are left queued
+MAX_RATE_LIMIT_WAIT_S = 30
+# How often the forwarder retries deferred events when nothing new is queued
+FORWARDER_RETRY_INTERVAL_S = 30
+METRICS_FILENAME = "forwarder.prom"
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+# struct inotify_event, without its name
+INOTIFY_EVENT_FORMAT = "iIII"
+# Most SQLite builds allow 999 variables per statement, or 32766 since 3.32
+MAX_SQL_VARIABLES = 999
 
 
-def main():
-    args = parse_args()
-    handle_proxy(args)
-    configure_logging(args.verbose)
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_enqueue_args(argv)
+    fast_path = args is not None
+    if not fast_path:
+        args = parse_args(argv)
+        handle_proxy(args)
+        configure_logging(args.verbose)
     try:
-        os.makedirs(args.queue_dir, exist_ok=True)
-        if args.command == "enqueue":
-            enqueue_event(args)
-            lock_and_flush_queue(args)
-        elif args.command == "flush":
-            lock_and_flush_queue(args)
+        run(args)
     except Exception:
+        import logging
+        import traceback
+
+        if fast_path:
+            configure_logging(args.verbose)
         logging.error(traceback.format_exc())
         if not args.verbose:
             print("An error occurred; check syslog for details", file=sys.stderr)
 
 
-def parse_args():
+def run(args):
+    os.makedirs(args.queue_dir, exist_ok=True)
+    if args.command == "enqueue":
+        enqueue_event(args)
+        if not args.no_flush:
+            lock_and_flush_queue(args, wait=False)
+    elif args.command == "flush":
+        lock_and_flush_queue(args, wait=False)
+    elif args.command == "forward":
+        forward(args)
+
+
+def parse_args(argv=None):
+    import argparse
+
     ap = argparse.ArgumentParser(
         description="""\
 This script passes events from Nagios to the PagerDuty alert system. It's
@@ -95,14 +140,19 @@ When called in the "flush" mode, the script simply tries to send any enqueued
 events to the PagerDuty server.  This mode is typically invoked by cron.  The
 purpose of this mode is to retry any events that couldn't be sent to the
 PagerDuty server for whatever reason when they were initially enqueued.
+
+When called in the "forward" mode, the script runs until killed, sending events
+as soon as they are enqueued and retrying deferred ones periodically.  This mode
+replaces the cron job when the forwarder service is enabled; the notification
+handlers then enqueue with --no-flush.
 """,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    ap.add_argument("command", choices=["enqueue", "flush"])
+    ap.add_argument("command", choices=["enqueue", "flush", "forward"])
     ap.add_argument(
         "-a",
         "--api-base",
-        default="https://events.pagerduty.com/nagios/2010-04-15",
+        default=DEFAULT_API_BASE,
         help="The base URL used to communicate with PagerDuty.  "
         "The default option here should be fine, but adjusting it "
         "may make sense if your firewall doesn't pass HTTPS "
@@ -112,7 +162,7 @@ PagerDuty server for whatever reason when they were initially enqueued.
     ap.add_argument(
         "-q",
         "--queue-dir",
-        default="/tmp/pagerduty_nagios",
+        default=DEFAULT_QUEUE_DIR,
         help="Path to the directory to use to store the event "
         "queue.  Default: %(default)s",
     )
@@ -121,14 +171,59 @@ PagerDuty server for whatever reason when they were initially enqueued.
         "--field",
         default=[],
         nargs="+",
-        help="Add this key-value pair to the event being passed "
-        "to PagerDuty.  The script automatically gathers Nagios "
-        "macros out of the environment, so there's no need to "
-        "specify these explicitly.  This option can be repeated "
+        action="extend",
+        help="Add these key-value pairs to the event being passed "
+        "to PagerDuty, e.g. 'HOSTNAME=$HOSTNAME$'.  The script also "
+        "gathers Nagios macros out of the environment when "
+        "enable_environment_macros is on; fields given here take "
+        "precedence.  This option can be repeated "
         "as many times as necessary to pass multiple key-value "
         "pairs.  This option is only useful when an event is "
         "being enqueued.",
     )
+    ap.add_argument(
+        "-w",
+        "--workers",
+        default=DEFAULT_WORKERS,
+        type=int,
+        help="Number of events sent to PagerDuty concurrently, each over its "
+        "own keep-alive connection.  Events about the same host or service "
+        "are always sent in order.  Default: %(default)s",
+    )
+    ap.add_argument(
+        "--max-attempts",
+        default=DEFAULT_MAX_ATTEMPTS,
+        type=int,
+        help="Number of times an event is tried, with growing delays, when "
+        "the network or the PagerDuty server fails before it is left in "
+        "the queue for the next flush.  Default: %(default)s",
+    )
+    ap.add_argument(
+        "--rate",
+        default=DEFAULT_RATE,
+        type=float,
+        help="Events sent per second for each PagerDuty integration key, once "
+        "a burst of --burst events has been sent.  Default: %(default)s",
+    )
+    ap.add_argument(
+        "--burst",
+        default=DEFAULT_BURST,
+        type=int,
+        help="Events sent for an integration key at once after it was idle.  "
+        "Default: %(default)s",
+    )
+    ap.add_argument(
+        "--no-flush",
+        default=False,
+        action="store_true",
+        help="Only enqueue the event, leaving it to a running forwarder to " "send it.",
+    )
+    ap.add_argument(
+        "--metrics-file",
+        help="Where the forwarder writes its queue depth and send latency "
+        "metrics, in the Prometheus text format.  Default: {} in the queue "
+        "directory".format(METRICS_FILENAME),
+    )
     ap.add_argument(
         "-v",
         "--verbose",
@@ -158,7 +253,66 @@ PagerDuty server for whatever reason when they were initially enqueued.
         default="",
         help="Use a proxy for the connections like " '"--proxy http://127.0.0.1:8888/"',
     )
-    return ap.parse_args()
+    return ap.parse_args(argv)
+
+
+# The options of the notification commands, which parse_enqueue_args() knows
+ENQUEUE_FLAGS = {
+    "-A": "all_variables",
+    "--all-variables": "all_variables",
+    "--ignore-extended-notifications": "ignore_extended_notifications",
+    "--no-flush": "no_flush",
+    "-v": "verbose",
+    "--verbose": "verbose",
+}
+ENQUEUE_OPTIONS = {
+    "-q": "queue_dir",
+    "--queue-dir": "queue_dir",
+    "-p": "proxy",
+    "--proxy": "proxy",
+}
+
+
+def parse_enqueue_args(argv):
+    """Parse the arguments of a notification for a forwarder, without argparse.
+
+    Enqueueing with --no-flush is all a notification does when a forwarder runs,
+    and this spares it the import of argparse.  Returns None for any other
+    command line, which is left to parse_args().
+    """
+    args = SimpleNamespace(
+        command=None,
+        queue_dir=DEFAULT_QUEUE_DIR,
+        field=[],
+        proxy="",
+        all_variables=False,
+        ignore_extended_notifications=False,
+        no_flush=False,
+        verbose=False,
+    )
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg in ENQUEUE_FLAGS:
+            setattr(args, ENQUEUE_FLAGS[arg], True)
+        elif arg in ENQUEUE_OPTIONS and i < len(argv) and argv[i][:1] != "-":
+            setattr(args, ENQUEUE_OPTIONS[arg], argv[i])
+            i += 1
+        elif arg in ("-f", "--field"):
+            start = i
+            while i < len(argv) and argv[i][:1] != "-":
+                i += 1
+            if i == start:
+                return None
+            args.field.extend(argv[start:i])
+        elif arg == "enqueue" and args.command is None:
+            args.command = arg
+        else:
+            return None
+    if args.command != "enqueue" or not args.no_flush:
+        return None
+    return args
 
 
 def handle_proxy(args):
@@ -170,6 +324,9 @@ def handle_proxy(args):
 
 
 def configure_logging(verbose):
+    import logging
+    import logging.handlers
+
     handlers = [
         logging.handlers.SysLogHandler(
             address="/dev/log",
@@ -198,9 +355,13 @@ REQUIRED_KEYS = [
     # command line via the -f/--field argument when invoked via Nagios.
 ]
 
+# The notification types that trigger or resolve a PagerDuty incident
+STATE_TRANSITIONS = ("PROBLEM", "RECOVERY")
+
 RECOMMENDED_KEYS = [
     "SERVICEOUTPUT",  # The text of the alert.  Placed just above the arg
     # table in the Web UI.
+    "HOSTOUTPUT",  # The text of host alerts.
     "HOSTADDRESS",  # IP address of the host
     "SHORTDATETIME",  # Timestamp of the event (doesn't specify time zone)
     "LONGDATETIME",  # Timestamp of the event (long version, specifies UTC)
@@ -235,10 +396,11 @@ def enqueue_event(args):
         if any(
             notification_type.startswith(prefix) for prefix in ("FLAPPING", "DOWNTIME")
         ):
-            service_state = event["SERVICESTATE"]
-            if service_state == "OK":
+            # Host notifications have no service state
+            state = event.get("SERVICESTATE") or event.get("HOSTSTATE")
+            if state in ("OK", "UP"):
                 new_type = "RECOVERY"
-            elif service_state == "CRITICAL":
+            elif state == "CRITICAL":
                 new_type = "PROBLEM"
             else:
                 # For now; treat all other cases as problems as well
@@ -246,76 +408,673 @@ def enqueue_event(args):
             event["COERCEDFROMTYPE"] = notification_type
             event["NOTIFICATIONTYPE"] = new_type
 
-    event_file = os.path.join(
-        args.queue_dir, "pd_{}_{}.txt".format(int(time.time()), os.getpid())
-    )
-    with open(event_file, "w") as outfile:
-        for key, value in event.items():
-            outfile.write("{}={}\n".format(key, value))
+    event_queue = EventQueue(args.queue_dir)
+    try:
+        event_queue.put(event)
+    finally:
+        event_queue.close()
+
 
+def lock_and_flush_queue(args, pool=None, metrics=None, event_queue=None, wait=True):
+    """Flush the queue, holding the lock that serializes flushes.
 
-def lock_and_flush_queue(args):
+    Unless ``wait`` is set, the flush is skipped when the queue is already being
+    drained, which under rate limiting can take minutes; the process draining it
+    picks up new events too, or else the next flush does.  Returns None then.
+    Only the forwarder waits.
+    """
     lockfile = os.path.join(args.queue_dir, "lockfile")
     with open(lockfile, "w") as outfile:
-        fcntl.flock(outfile.fileno(), fcntl.LOCK_EX)
-        return flush_queue(args)
+        try:
+            fcntl.flock(
+                outfile.fileno(),
+                fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB,
+            )
+        except BlockingIOError:
+            return None
+        return flush_queue(args, pool, metrics, event_queue)
 
 
-def flush_queue(args):
-    queue = get_queue_from_dir(args)
-    for file in queue:
-        path = os.path.join(args.queue_dir, file)
-        if args.verbose:
-            print("=== Now processing: {}".format(path))
-        with open(path) as infile:
-            event = {}
-            for line in infile:
-                key, value = line.strip().split("=", 1)
-                event[key] = value
-        request = Request(
-            args.api_base + "/create_event", data=urlencode(event).encode()
+def flush_queue(args, pool=None, metrics=None, event_queue=None):
+    """Send the queued events and remove the ones the server handled.
+
+    The events of each host and service are sent in order by one worker, so a
+    recovery never overtakes its problem; a deferred event holds back the later
+    events for the same incident but not the others.  Returns True unless some
+    event was deferred.
+
+    ``pool`` is a ConnectionPool and ``event_queue`` an EventQueue to reuse, and
+    ``metrics`` a ForwarderMetrics to record the outcome of each event in.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    own_queue = event_queue is None
+    if own_queue:
+        event_queue = EventQueue(args.queue_dir)
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool(args.api_base, max(1, args.workers))
+    limiter = RateLimiter(args.rate, args.burst, event_queue.get_rate_limits())
+    try:
+        import_legacy_events(args, event_queue)
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            return flush_batches(args, pool, limiter, metrics, event_queue, executor)
+    finally:
+        event_queue.set_rate_limits(limiter.buckets)
+        if own_pool:
+            pool.close()
+        if own_queue:
+            event_queue.close()
+
+
+def flush_batches(args, pool, limiter, metrics, event_queue, executor):
+    import logging
+
+    # Incidents with a deferred event, whose later events have to wait
+    held = set()
+    last_seq = 0
+    while True:
+        batch = event_queue.get_batch(after=last_seq)
+        if not batch:
+            # Everything that was intended to be sent, was sent and handled in
+            # some way.  (Minus stuff needing a retry.)
+            return not held
+        last_seq = batch[-1].seq
+        incidents = {}
+        for item in batch:
+            key = incident_key(item.event)
+            if key not in held:
+                incidents.setdefault(key, []).append(item)
+        done = []
+        for key, items in incidents.items():
+            incidents[key], superseded = coalesce_events(items)
+            for item in superseded:
+                logging.info("Nagios event %d SUPERSEDED by a later event.", item.seq)
+                if metrics is not None:
+                    metrics.record("superseded", item)
+                done.append(item.seq)
+        results = executor.map(
+            lambda items: send_incident_events(args, pool, limiter, items, metrics),
+            incidents.values(),
         )
+        for key, (handled, deferred) in zip(list(incidents), results):
+            done.extend(handled)
+            if deferred:
+                held.add(key)
+        event_queue.remove(done)
+
+
+def send_incident_events(args, pool, limiter, items, metrics=None):
+    """Send an incident's events in order, stopping at the first deferred one.
+
+    Returns the sequence numbers of the events handled, and whether one was
+    deferred.
+    """
+    handled = []
+    for item in items:
+        if args.verbose:
+            print("=== Now processing: event {}".format(item.seq))
+        with pool.connection() as connection:
+            outcome = send_event(args, connection, limiter, item)
+        if metrics is not None:
+            metrics.record(outcome, item)
+        if outcome == "deferred":
+            return handled, True
+        handled.append(item.seq)
+    return handled, False
+
+
+def send_event(args, connection, limiter, item):
+    """Post a queued event when its integration key's rate allows, retrying failures.
+
+    Returns "accepted", "rejected" or, if it should stay queued, "deferred".
+    """
+    import http.client
+    import logging
+
+    key = item.event.get("CONTACTPAGER", "")
+    for _ in range(max(1, args.max_attempts)):
+        if not limiter.acquire(key, MAX_RATE_LIMIT_WAIT_S):
+            logging.warning("Nagios event %d DEFERRED due to rate limiting.", item.seq)
+            return "deferred"
         try:
-            urlopen(request, timeout=TIMEOUT_S)
-        except HTTPError as e:
-            if 400 <= e.code < 500:
-                # Client error
-                content = e.fp.read().decode()
-                logging.warning(
-                    "Nagios event in file %s REJECTED by the PagerDuty server.  "
-                    "Server says: %s",
-                    path,
-                    content,
+            status, content, retry_after = connection.post(item.event)
+        except (http.client.HTTPException, OSError) as e:
+            logging.debug("Sending nagios event %d failed: %s", item.seq, e)
+            limiter.back_off(key)
+            continue
+        if 200 <= status < 300:
+            logging.info("Nagios event %d ACCEPTED by the PagerDuty server.", item.seq)
+            limiter.succeeded(key)
+            return "accepted"
+        if status == 429 or (400 <= status < 500 and "retry later" in content):
+            logging.info("Nagios event %d THROTTLED by the PagerDuty server.", item.seq)
+            limiter.back_off(key, retry_after)
+            continue
+        if 400 <= status < 500:
+            # Client error
+            logging.warning(
+                "Nagios event %d REJECTED by the PagerDuty server.  " "Server says: %s",
+                item.seq,
+                content,
+            )
+            return "rejected"
+        limiter.back_off(key)
+    logging.warning(
+        "Nagios event %d DEFERRED due to network/server problems.", item.seq
+    )
+    return "deferred"
+
+
+def forward(args):
+    """Send events as they are queued, until killed.
+
+    Connections are kept open between flushes, and the metrics file is updated
+    after each one.
+    """
+    import logging
+
+    metrics_file = args.metrics_file or os.path.join(args.queue_dir, METRICS_FILENAME)
+    pool = ConnectionPool(args.api_base, max(1, args.workers))
+    metrics = ForwarderMetrics()
+    # Watching starts before the first flush, so no event can slip in between
+    watcher = QueueWatcher(args.queue_dir)
+    # The queue stays open: closing it would look like an enqueue to the watcher
+    event_queue = EventQueue(args.queue_dir)
+    logging.info("Forwarding nagios events queued in %s", args.queue_dir)
+    try:
+        while True:
+            lock_and_flush_queue(args, pool, metrics, event_queue)
+            metrics.queue_depth = len(event_queue)
+            metrics.write(metrics_file)
+            watcher.wait(FORWARDER_RETRY_INTERVAL_S)
+    finally:
+        event_queue.close()
+        watcher.close()
+        pool.close()
+
+
+class QueueWatcher:
+    """Waits for events to be written to the queue directory.
+
+    Enqueueing closes the queue database after writing to it, which is what is
+    watched for, along with legacy event files.
+
+    Uses inotify through libc, as the standard library has no binding for it.
+    """
+
+    def __init__(self, queue_dir):
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if (
+            libc.inotify_add_watch(
+                self.fd, os.fsencode(queue_dir), IN_CLOSE_WRITE | IN_MOVED_TO
+            )
+            < 0
+        ):
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "Unable to watch {}".format(queue_dir))
+
+    def wait(self, timeout):
+        """Wait up to ``timeout`` seconds; returns True if an event was queued."""
+        import select
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                return False
+            if any(
+                name.startswith((QUEUE_DB.encode(), b"pd_"))
+                for name in self._read_names()
+            ):
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+    def _read_names(self):
+        import struct
+
+        header = struct.Struct(INOTIFY_EVENT_FORMAT)
+        names = []
+        try:
+            while True:
+                data = os.read(self.fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    _, _, _, length = header.unpack_from(data, offset)
+                    start = offset + header.size
+                    offset = start + length
+                    names.append(data[start:offset].rstrip(b"\0"))
+        except BlockingIOError:
+            pass
+        return names
+
+
+class ForwarderMetrics:
+    """Counters describing the forwarder, for the metrics file."""
+
+    def __init__(self):
+        import threading
+
+        self._lock = threading.Lock()
+        self.outcomes = dict.fromkeys(
+            ("accepted", "rejected", "deferred", "superseded"), 0
+        )
+        self.queue_depth = 0
+        # From enqueue to being accepted by PagerDuty
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.last_latency = 0.0
+
+    def record(self, outcome, item):
+        latency = None
+        if outcome == "accepted":
+            latency = max(0.0, time.time() - item.enqueued)
+        with self._lock:
+            self.outcomes[outcome] += 1
+            if latency is not None:
+                self.latency_sum += latency
+                self.latency_count += 1
+                self.last_latency = latency
+
+    def render(self):
+        with self._lock:
+            lines = [
+                "# TYPE pagerduty_nagios_queue_depth gauge",
+                "pagerduty_nagios_queue_depth {}".format(self.queue_depth),
+                "# TYPE pagerduty_nagios_events_total counter",
+            ]
+            lines.extend(
+                'pagerduty_nagios_events_total{{outcome="{}"}} {}'.format(
+                    outcome, count
                 )
-                if "retry later" not in content:
-                    os.unlink(path)
+                for outcome, count in sorted(self.outcomes.items())
+            )
+            lines.extend(
+                [
+                    "# TYPE pagerduty_nagios_send_latency_seconds summary",
+                    "pagerduty_nagios_send_latency_seconds_sum {:.3f}".format(
+                        self.latency_sum
+                    ),
+                    "pagerduty_nagios_send_latency_seconds_count {}".format(
+                        self.latency_count
+                    ),
+                    "# TYPE pagerduty_nagios_last_send_latency_seconds gauge",
+                    "pagerduty_nagios_last_send_latency_seconds {:.3f}".format(
+                        self.last_latency
+                    ),
+                ]
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        import tempfile
+
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".", suffix=".tmp", delete=False
+        ) as outfile:
+            outfile.write(self.render())
+        os.chmod(outfile.name, 0o644)
+        os.rename(outfile.name, path)
+
+
+def coalesce_events(events):
+    """Drop the queued events of an incident made obsolete by later ones.
+
+    Only the latest state transition (PROBLEM or RECOVERY) matters to PagerDuty,
+    so during flapping everything before it, including acknowledgements of the
+    earlier problems, is superseded.  Returns the events to send and the
+    superseded ones.
+    """
+    for i in range(len(events) - 1, 0, -1):
+        if events[i].event.get("NOTIFICATIONTYPE") in STATE_TRANSITIONS:
+            return events[i:], events[:i]
+    return events, []
+
+
+def read_event(path):
+    event = {}
+    with open(path) as infile:
+        for line in infile:
+            key, value = line.strip().split("=", 1)
+            event[key] = value
+    return event
+
+
+def incident_key(event):
+    # Each contact pages its own PagerDuty service, with its own incidents
+    return (
+        event.get("CONTACTPAGER"),
+        event.get("pd_nagios_object"),
+        event.get("HOSTNAME"),
+        event.get("SERVICEDESC"),
+    )
+
+
+class PagerDutyConnection:
+    """A keep-alive HTTP(S) connection to the PagerDuty events API.
+
+    The https_proxy/http_proxy environment variables are honoured, as they were
+    by urllib.
+    """
+
+    def __init__(self, api_base, timeout=TIMEOUT_S):
+        from urllib.parse import urlsplit
+
+        self.url = urlsplit(api_base.rstrip("/") + "/create_event")
+        self.timeout = timeout
+        self._connection = self._target = None
+
+    def post(self, event):
+        """Post an event and return the response status, body and Retry-After.
+
+        Retry-After is in seconds, or None if the server didn't send it.
+        """
+        import http.client
+        from urllib.parse import urlencode
+
+        body = urlencode(event).encode()
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        # An idle keep-alive connection may have been closed by the server
+        reused = self._connection is not None
+        while True:
+            if self._connection is None:
+                self._connection, self._target = self._connect()
+            try:
+                self._connection.request("POST", self._target, body, headers)
+                response = self._connection.getresponse()
+                content = response.read().decode(errors="replace")
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if not reused:
+                    raise
+                reused = False
+                continue
+            if response.will_close:
+                self.close()
+            return (
+                response.status,
+                content,
+                parse_retry_after(response.getheader("Retry-After")),
+            )
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _connect(self):
+        import http.client
+        from urllib.parse import urlsplit
+        from urllib.request import getproxies, proxy_bypass
+
+        url = self.url
+        https = url.scheme == "https"
+        target = url.path + ("?" + url.query if url.query else "")
+        port = url.port or (443 if https else 80)
+        proxy = getproxies().get(url.scheme)
+        if proxy and not proxy_bypass(url.hostname):
+            proxy = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+            proxy_port = proxy.port or 80
+            if https:
+                connection = http.client.HTTPSConnection(
+                    proxy.hostname, proxy_port, timeout=self.timeout
+                )
+                connection.set_tunnel(url.hostname, port)
             else:
-                logging.warning(
-                    "Nagios event in file %s DEFERRED due to network/server problems.",
-                    path,
+                connection = http.client.HTTPConnection(
+                    proxy.hostname, proxy_port, timeout=self.timeout
                 )
-                return False
+                target = "http://{}:{}{}".format(url.hostname, port, target)
+        elif https:
+            connection = http.client.HTTPSConnection(
+                url.hostname, port, timeout=self.timeout
+            )
         else:
-            # Success
-            logging.info(
-                "Nagios event in file %s ACCEPTED by the PagerDuty server.", path
+            connection = http.client.HTTPConnection(
+                url.hostname, port, timeout=self.timeout
             )
-            os.unlink(path)
-    # Everything that was intended to be sent, was sent and handled in some way.
-    # (Minus stuff needing a retry.)
-    return True
+        return connection, target
+
+
+def parse_retry_after(value):
+    """Return the seconds to wait from a Retry-After header, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """A token bucket per PagerDuty integration key, with back-off on failures.
+
+    ``buckets`` maps each key to [tokens, updated, failures]: the tokens left at
+    time ``updated``, which is in the future while the key backs off, and the
+    failures in a row.  It is kept in the queue database between flushes, so
+    throttling carries over from one flush to the next.
+    """
+
+    def __init__(self, rate, burst, buckets=None):
+        import threading
+
+        self.rate = max(rate, 0.001)
+        self.burst = max(burst, 1)
+        self.buckets = buckets if buckets is not None else {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, max_wait):
+        """Wait for a token of ``key``.
+
+        Returns False, without waiting, when that would take over ``max_wait``
+        seconds.
+        """
+        deadline = time.time() + max_wait
+        while True:
+            wait = self._take(key)
+            if not wait:
+                return True
+            if time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def back_off(self, key, retry_after=None):
+        """Hold back the events of ``key`` after a failure or throttling.
+
+        The server's ``retry_after`` is honoured; otherwise the delay doubles
+        with each failure in a row.  Jitter keeps forwarders from retrying in
+        step.
+        """
+        import random
+
+        with self._lock:
+            bucket = self._bucket(key)
+            bucket[2] += 1
+            if retry_after is None:
+                delay = min(MAX_RETRY_DELAY_S, RETRY_DELAY_S * 2 ** (bucket[2] - 1))
+                retry_after = delay * random.uniform(0.5, 1)
+            # One event is sent when the back-off ends, and then the rate applies
+            bucket[0] = 1.0
+            bucket[1] = max(bucket[1], time.time() + retry_after)
+
+    def succeeded(self, key):
+        with self._lock:
+            self._bucket(key)[2] = 0
+
+    def _take(self, key):
+        """Take a token of ``key``; otherwise return the seconds until one is due."""
+        with self._lock:
+            bucket = self._bucket(key)
+            now = time.time()
+            if now < bucket[1]:
+                return bucket[1] - now
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate
+
+    def _bucket(self, key):
+        if key not in self.buckets:
+            self.buckets[key] = [float(self.burst), time.time(), 0]
+        return self.buckets[key]
+
+
+class ConnectionPool:
+    """A bounded set of PagerDutyConnections shared by the flush workers."""
+
+    def __init__(self, api_base, size):
+        import queue
+
+        self.size = size
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(PagerDutyConnection(api_base))
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self._idle.get()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def close(self):
+        for connection in list(self._idle.queue):
+            connection.close()
+
+
+def import_legacy_events(args, event_queue):
+    """Move event files queued by earlier versions of the script into the queue."""
+    for file in get_queue_from_dir(args):
+        path = os.path.join(args.queue_dir, file)
+        event_queue.put(read_event(path), os.path.getmtime(path))
+        os.unlink(path)
 
 
 def get_queue_from_dir(args):
+    """List the legacy pd_<epoch>_<pid>.txt event files, oldest first."""
+    import re
+
     timestamp_file_pairs = []
     for file in os.listdir(args.queue_dir):
-        match = re.match(r"^pd_(\d+)_\d+.txt$", file)
+        match = re.match(r"^pd_(\d+)_(\d+).txt$", file)
         if match:
-            timestamp = match.group(1)
+            timestamp = (int(match.group(1)), int(match.group(2)))
             timestamp_file_pairs.append((timestamp, file))
     timestamp_file_pairs.sort(key=lambda x: x[0])
     return [t[1] for t in timestamp_file_pairs]
 
 
+QueuedEvent = namedtuple("QueuedEvent", ("seq", "enqueued", "event"))
+
+
+class EventQueue:
+    """The event queue, a SQLite database in the queue directory.
+
+    Events are numbered by a sequence that only ever increases, and are sent in
+    that order.  Enqueueing is a single insert, and the database is in WAL mode,
+    so it doesn't wait for a flush in progress.  A crashed flush leaves the
+    events it didn't finish in the queue.
+
+    The database also keeps the RateLimiter's state between flushes.
+    """
+
+    def __init__(self, queue_dir):
+        self._db = sqlite3.connect(
+            os.path.join(queue_dir, QUEUE_DB), timeout=30, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "enqueued REAL NOT NULL, "
+            "event TEXT NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            "key TEXT PRIMARY KEY, "
+            "tokens REAL NOT NULL, "
+            "updated REAL NOT NULL, "
+            "failures INTEGER NOT NULL)"
+        )
+
+    def put(self, event, enqueued=None):
+        # SQLite serializes the event, which spares enqueueing the json module
+        values = [item for pair in event.items() for item in pair]
+        if len(values) < MAX_SQL_VARIABLES:
+            serialized = "json_object({})".format(", ".join("?" * len(values)))
+        else:
+            import json
+
+            serialized = "?"
+            values = [json.dumps(event)]
+        self._db.execute(
+            "INSERT INTO events (enqueued, event) VALUES (?, {})".format(serialized),
+            [time.time() if enqueued is None else enqueued] + values,
+        )
+
+    def get_batch(self, after=0, limit=None):
+        """Return the first events queued after sequence number ``after``."""
+        import json
+
+        rows = self._db.execute(
+            "SELECT seq, enqueued, event FROM events WHERE seq > ? "
+            "ORDER BY seq LIMIT ?",
+            (after, limit or FLUSH_BATCH_SIZE),
+        )
+        return [
+            QueuedEvent(seq, enqueued, json.loads(event))
+            for seq, enqueued, event in rows
+        ]
+
+    def remove(self, seqs):
+        self._db.execute("BEGIN")
+        self._db.executemany(
+            "DELETE FROM events WHERE seq = ?", ((seq,) for seq in seqs)
+        )
+        self._db.execute("COMMIT")
+
+    def get_rate_limits(self):
+        return {
+            key: [tokens, updated, failures]
+            for key, tokens, updated, failures in self._db.execute(
+                "SELECT key, tokens, updated, failures FROM rate_limits"
+            )
+        }
+
+    def set_rate_limits(self, buckets):
+        self._db.execute("BEGIN")
+        self._db.execute("DELETE FROM rate_limits")
+        self._db.executemany(
+            "INSERT INTO rate_limits VALUES (?, ?, ?, ?)",
+            ((key,) + tuple(bucket) for key, bucket in buckets.items()),
+        )
+        self._db.execute("COMMIT")
+
+    def __len__(self):
+        """Return the number of queued events."""
+        return self._db.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
 if __name__ == "__main__":
     main()
@@ -1,42 +1,69 @@
+import contextlib
+import ctypes
 import glob
 import hashlib
+import json
 import os
 import os.path
 import re
 import shutil
 import socket
-import subprocess
 import tempfile
 import time
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.hookenv import (
     config,
     log,
     network_get,
     network_get_primary_address,
+    related_units,
     relation_get,
+    relation_id,
+    remote_unit,
     unit_get,
 )
 from charmhelpers.core.host import service_reload
 
 from pynag import Model
 
+from livestatus_client import LivestatusError, get_config_client
+
+from nagios_objects import ObjectIndex
+
+import status_dat
+
 INPROGRESS_DIR = "/etc/nagios4-inprogress"
 INPROGRESS_CFG = "/etc/nagios4-inprogress/nagios.cfg"
 INPROGRESS_CONF_D = "/etc/nagios4-inprogress/conf.d"
 OLD_CHARM_CFG = "/etc/nagios4-inprogress/conf.d/charm.cfg"
 HOST_TEMPLATE = "/etc/nagios4-inprogress/conf.d/juju-host_{}.cfg"
 HOSTGROUP_TEMPLATE = "/etc/nagios4-inprogress/conf.d/juju-hostgroup_{}.cfg"
+COMMANDS_CFG = "/etc/nagios4-inprogress/conf.d/juju-commands.cfg"
+# Under INPROGRESS_CONF_D; see get_host_shard_dir()
+HOST_SHARDS_DIRNAME = "juju-hosts"
+# Left by earlier versions of the charm; see flush_inprogress_config()
 MAIN_NAGIOS_BAK = "/etc/nagios4.bak"
+MAIN_NAGIOS_PREVIOUS = "/etc/nagios4-previous"
 MAIN_NAGIOS_DIR = "/etc/nagios4"
 MAIN_NAGIOS_CFG = "/etc/nagios4/nagios.cfg"
 PLUGIN_PATH = "/usr/lib/nagios/plugins"
+RELOAD_PENDING_FILE = "/var/lib/juju/nagios.reload-pending"
+STATUS_DAT = "/var/lib/nagios4/status.dat"
+NAGIOS_LOG = "/var/log/nagios4/nagios.log"
+SIGHUP_MESSAGE = b"Caught SIGHUP, restarting"
+
+# renameat2(2) constants, used to swap the in-progress and live config trees
+AT_FDCWD = -100
+RENAME_EXCHANGE = 1 << 1
 
 MODEL_ID_KEY = "model_id"
 TARGET_ID_KEY = "target-id"
 
 HOST_PREFIX_MIN_LENGTH = 7
 HOST_PREFIX_MAX_LENGTH = 64  # max length of sha256sum in hex
+# Hex digits of the command line hash in generated command names
+COMMAND_HASH_LENGTH = 12
 
 SANITIZE_ESCAPE_CHAR = "%"
 SANITIZE_CHARS = [
@@ -45,11 +72,24 @@ SANITIZE_CHARS = [
     "*",
 ]
 
-Model.cfg_file = INPROGRESS_CFG
-Model.pynag_directory = INPROGRESS_CONF_D
-
 REDUCE_RE = re.compile(r"[\W_]")
 
+CONFIG_DIGESTS_KEY = "nagios.config-digests"
+HOST_CONFIG_LAYOUT_KEY = "nagios.host-config-layout"
+HOOK_TIMINGS_KEY = "nagios.hook-timings"
+HOOK_TIMINGS_HISTORY = 100
+
+# Remote unit settings fetched during this hook, keyed by (relation id, unit)
+_relation_data = {}
+# Objects of the in-progress config, parsed once per hook by get_object_index()
+_object_index = None
+# Check commands of the in-progress config, see get_command_registry()
+_command_registry = None
+# Digests of the files written by this hook, committed once the config is live
+_pending_digests = {}
+# Seconds spent in each phase of this hook, see timed_phase()
+_phase_timings = {}
+
 
 def check_ip(n):
     try:
@@ -94,13 +134,34 @@ def get_local_ingress_address(binding="website"):
     return hostname
 
 
-def get_remote_relation_attr(remote_unit, attr_name, relation_id=None):
-    args = ["relation-get", attr_name, remote_unit]
+def get_relation_data(rid=None, unit=None):
+    """Return all settings of a remote unit, fetching them at most once per hook.
 
-    if relation_id is not None:
-        args.extend(["-r", relation_id])
+    Without arguments, the relation and remote unit of the current hook are used.
+    A copy is returned, so callers are free to modify it.
+    """
+    key = (rid or relation_id(), unit or remote_unit())
+    if key not in _relation_data:
+        if rid is None and unit is None:
+            _relation_data[key] = relation_get()
+        else:
+            _relation_data[key] = relation_get(unit=unit, rid=rid)
+    data = _relation_data[key]
+    return dict(data) if data else data
+
+
+def get_relation_units_data(rid):
+    """Return the settings of every unit on a relation, as {unit: settings}.
+
+    There is no hook tool to read several units at once, so this costs one
+    relation-get per unit; every later lookup for those units is served from the
+    cache, including the address lookups which used to fork relation-get again.
+    """
+    return {unit: get_relation_data(rid, unit) for unit in related_units(rid)}
 
-    return subprocess.check_output(args).strip()
+
+def get_remote_relation_attr(remote_unit, attr_name, relation_id=None):
+    return (get_relation_data(relation_id, remote_unit) or {}).get(attr_name)
 
 
 def get_ip_and_hostname(remote_unit, relation_id=None):
@@ -123,64 +184,93 @@ def get_ip_and_hostname(remote_unit, relation_id=None):
     return (ip_address, remote_unit.replace("/", "-"))
 
 
-def refresh_hostgroups():  # noqa:C901
-    """Parse the on-disk hostgroups and regenerate, removing any old hosts."""
-    hosts = [x["host_name"] for x in Model.Host.objects.all if x["host_name"]]
-
-    hgroups = {}
+def refresh_hostgroups():
+    """Bring the autogenerated hostgroups in line with the hosts of the config.
 
-    for host in hosts:
-        hgroup_name = get_hostgroup_name(host)
-        if hgroup_name is None:
-            continue
-        hgroups.setdefault(hgroup_name, []).append(host)
-
-    # Find existing autogenerated
-    auto_hgroups = Model.Hostgroup.objects.filter(notes__contains="#autogenerated#")
-    auto_hgroups = [x.get_attribute("hostgroup_name") for x in auto_hgroups]
-
-    # Delete the ones not in hgroups
-    to_delete = set(auto_hgroups).difference(set(hgroups.keys()))
-
-    for hgroup_name in to_delete:
-        try:
-            hgroup = Model.Hostgroup.objects.get_by_shortname(hgroup_name)
+    Only the hostgroups whose membership changed are saved, and so rewritten.
+    """
+    index = get_object_index()
+    hgroups = index.group("host", get_hostgroup_name)
+
+    # Delete the autogenerated hostgroups which no longer have any hosts
+    for hgroup in index.all("hostgroup"):
+        if (
+            "#autogenerated#" in (hgroup["notes"] or "")
+            and hgroup["hostgroup_name"] not in hgroups
+        ):
             hgroup.delete()
-        except (ValueError, KeyError):
-            pass
 
     for hgroup_name, members in hgroups.items():
-        if os.path.exists(get_nagios_hostgroup_config_path(hgroup_name)):
-            # Skip updating files unrelated to the hook at hand unless they were
-            # deliberately removed with the intent of them being rewritten.
-            continue
-        try:
-            hgroup = Model.Hostgroup.objects.get_by_shortname(hgroup_name)
-        except (ValueError, KeyError):
-            hgroup = Model.Hostgroup()
-            hgroup.set_filename(get_nagios_hostgroup_config_path(hgroup_name))
+        members = ",".join(sorted(members))
+        hgroup = index.get("hostgroup", hgroup_name)
+        if hgroup is None:
+            hgroup = index.new(
+                "hostgroup", get_nagios_hostgroup_config_path(hgroup_name)
+            )
             hgroup.set_attribute("hostgroup_name", hgroup_name)
             hgroup.set_attribute("notes", "#autogenerated#")
+        elif hgroup["members"] == members:
+            continue
 
-        hgroup.set_attribute("members", ",".join(members))
+        hgroup.set_attribute("members", members)
         hgroup.save()
 
 
 def _make_check_command(args):
-    args = [str(arg) for arg in args]
-    # There is some worry of collision, but the uniqueness of the initial
-    # command should be enough.
-    signature = REDUCE_RE.sub("_", "".join([os.path.basename(arg) for arg in args]))
-    Model.Command.objects.reload_cache()
-    try:
-        cmd = Model.Command.objects.get_by_shortname(signature)
-    except (ValueError, KeyError):
-        cmd = Model.Command()
-        cmd.set_attribute("command_name", signature)
-        cmd.set_attribute("command_line", " ".join(args))
-        cmd.save()
+    """Return the name of a command running ``args``, defining it if needed.
 
-    return signature
+    Commands are shared by every service with the same command line.  Their names
+    combine the plugin name with a hash of the command line, so they are stable
+    across hooks and units.
+    """
+    command_line = " ".join(str(arg) for arg in args)
+    registry = get_command_registry()
+    command_name = registry.get(command_line)
+    if command_name is not None:
+        return command_name
+
+    digest = hashlib.sha256(command_line.encode()).hexdigest()
+    prefix = REDUCE_RE.sub("_", os.path.basename(str(args[0])))
+    index = get_object_index()
+    command_name = "{}_{}".format(prefix, digest[:COMMAND_HASH_LENGTH])
+    if index.get("command", command_name) is not None:
+        # A truncated hash collision, or a command defined outside the charm
+        command_name = "{}_{}".format(prefix, digest)
+    cmd = index.new("command", COMMANDS_CFG)
+    cmd.set_attribute("command_name", command_name)
+    cmd.set_attribute("command_line", command_line)
+    cmd.save()
+    registry[command_line] = command_name
+    return command_name
+
+
+def get_command_registry():
+    """Return the charm's check commands as {command line: name}."""
+    global _command_registry
+    if _command_registry is None:
+        _command_registry = {
+            cmd["command_line"]: cmd["command_name"]
+            for cmd in get_object_index().all("command")
+            if cmd.get_filename() == COMMANDS_CFG
+        }
+    return _command_registry
+
+
+def prune_check_commands():
+    """Delete the charm's check commands which are no longer used by any service."""
+    index = get_object_index()
+    used = {
+        (obj["check_command"] or "").split("!", 1)[0]
+        for obj in index.all("service") + index.all("host")
+    }
+    registry = get_command_registry()
+    for command_line, command_name in list(registry.items()):
+        if command_name in used:
+            continue
+        cmd = index.get("command", command_name)
+        if cmd is not None and cmd.get_filename() == COMMANDS_CFG:
+            cmd.delete()
+        del registry[command_line]
 
 
 def _extend_args(args, cmd_args, switch, value):
@@ -401,12 +491,11 @@ def update_notification_options():
         service.save()
 
 
-def get_pynag_host(target_id, owner_unit=None, owner_relation=None):
-    try:
-        host = Model.Host.objects.get_by_shortname(target_id)
-    except (ValueError, KeyError):
-        host = Model.Host()
-        host.set_filename(get_nagios_host_config_path(target_id))
+def get_nagios_host(target_id, owner_unit=None, owner_relation=None, model_id=None):
+    index = get_object_index()
+    host = index.get("host", target_id)
+    if host is None:
+        host = index.new("host", get_nagios_host_config_path(target_id, model_id))
         host.set_attribute("host_name", target_id)
         host.set_attribute("use", "generic-host")
         # Adding the ubuntu icon image definitions to the host.
@@ -415,33 +504,92 @@ def get_pynag_host(target_id, owner_unit=None, owner_relation=None):
         host.set_attribute("vrml_image", "ubuntu.png")
         host.set_attribute("statusmap_image", "base/ubuntu.gd2")
         host.save()
-        host = Model.Host.objects.get_by_shortname(target_id)
     apply_host_policy(target_id, owner_unit, owner_relation)
 
     return host
 
 
-def get_pynag_service(target_id, service_name):
-    services = Model.Service.objects.filter(
-        host_name=target_id, service_description=service_name
-    )
+def get_nagios_service(target_id, service_name):
+    index = get_object_index()
+    service = index.get_service(target_id, service_name)
 
-    if len(services) == 0:
-        service = Model.Service()
-        service.set_filename(get_nagios_host_config_path(target_id))
+    if service is None:
+        # Services live in their host's file, wherever the layout put it
+        host = index.get("host", target_id)
+        if host is not None:
+            filename = host.get_filename()
+        else:
+            filename = get_nagios_host_config_path(target_id)
+        service = index.new("service", filename)
         service.set_attribute("service_description", service_name)
         service.set_attribute("host_name", target_id)
         service.set_attribute("use", "generic-service")
-    else:
-        service = services[0]
 
     return service
 
 
-def get_nagios_host_config_path(target_id):
+def get_nagios_host_config_path(target_id, model_id=None):
+    if host_config_layout() == "sharded":
+        return os.path.join(
+            get_host_shard_dir(target_id, model_id),
+            os.path.basename(HOST_TEMPLATE).format(sanitize_nagios_name(target_id)),
+        )
     return HOST_TEMPLATE.format(sanitize_nagios_name(target_id))
 
 
+def get_host_shard_dir(target_id, model_id=None):
+    """Return the directory of a host's config file in the sharded layout.
+
+    Hosts are grouped by model, then by application.  The de-duplication prefix of
+    the target id is left out of the application name, as the model already tells
+    duplicate host names apart.
+    """
+    name = target_id
+    if model_id:
+        sha_prefix = get_model_id_sha(model_id)[:HOST_PREFIX_MIN_LENGTH]
+        prefix, sep, rest = target_id.partition("_")
+        if sep and prefix.startswith(sha_prefix):
+            name = rest
+    application = get_hostgroup_name(name) or name
+    return os.path.join(
+        INPROGRESS_CONF_D,
+        HOST_SHARDS_DIRNAME,
+        sanitize_nagios_name(model_id or "default"),
+        sanitize_nagios_name(application),
+    )
+
+
+def get_host_shard_pattern(shard_dir=None):
+    """Return a glob matching the host files of one shard, or of all of them."""
+    if shard_dir is None:
+        shard_dir = os.path.join(INPROGRESS_CONF_D, HOST_SHARDS_DIRNAME, "*", "*")
+    return os.path.join(shard_dir, os.path.basename(HOST_TEMPLATE).format("*"))
+
+
+def remove_empty_host_shards():
+    """Remove the shard directories left without any host files."""
+    root = os.path.join(INPROGRESS_CONF_D, HOST_SHARDS_DIRNAME)
+    for dirpath, _, _ in os.walk(root, topdown=False):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass  # Not empty
+
+
+def host_config_layout():
+    """Return how host config files are laid out in conf.d: "flat" or "sharded"."""
+    return "sharded" if config("shard_host_config") else "flat"
+
+
+def host_config_layout_changed():
+    """Check whether the host config files are still in another layout."""
+    return unitdata.kv().get(HOST_CONFIG_LAYOUT_KEY, "flat") != host_config_layout()
+
+
+def save_host_config_layout():
+    unitdata.kv().set(HOST_CONFIG_LAYOUT_KEY, host_config_layout())
+
+
 def get_nagios_hostgroup_config_path(hostgroup_name):
     return HOSTGROUP_TEMPLATE.format(sanitize_nagios_name(hostgroup_name))
 
@@ -464,7 +612,7 @@ def sanitize_nagios_name(name):
 
 
 def apply_host_policy(target_id, owner_unit, owner_relation):
-    ssh_service = get_pynag_service(target_id, "SSH")
+    ssh_service = get_nagios_service(target_id, "SSH")
     ssh_service.set_attribute("check_command", "check_ssh")
     ssh_service.save()
 
@@ -480,23 +628,157 @@ def _replace_in_config(find_me, replacement):
             os.rename(new_cf.name, INPROGRESS_CFG)
 
 
-def _commit_in_config(find_me, replacement):
-    with open(MAIN_NAGIOS_CFG) as cf:
-        with tempfile.NamedTemporaryFile(dir=MAIN_NAGIOS_DIR, delete=False) as new_cf:
-            for line in cf:
-                new_cf.write(line.replace(find_me, replacement).encode())
-            new_cf.flush()
-            os.chmod(new_cf.name, 0o644)
-            os.unlink(MAIN_NAGIOS_CFG)
-            os.rename(new_cf.name, MAIN_NAGIOS_CFG)
-
-
 def initialize_inprogress_config(full_rewrite=False):
+    global _command_registry, _object_index
     if os.path.exists(INPROGRESS_DIR):
         shutil.rmtree(INPROGRESS_DIR)
-    shutil.copytree(MAIN_NAGIOS_DIR, INPROGRESS_DIR)
+    _stage_inprogress_tree()
     _replace_in_config(MAIN_NAGIOS_DIR, INPROGRESS_DIR)
     _initialize_inprogress_config_files(full_rewrite)
+    _object_index = None
+    _command_registry = None
+    _pending_digests.clear()
+
+
+def _stage_inprogress_tree():
+    """Stage the live config tree in the in-progress directory.
+
+    Files are hardlinked instead of copied, so staging costs one directory entry per
+    file rather than a full copy of every generated host file.  The hook only ever
+    unlinks and recreates staged files, or replaces them by rename, which leaves the
+    live inodes untouched.
+    """
+    shutil.copytree(
+        MAIN_NAGIOS_DIR, INPROGRESS_DIR, symlinks=True, copy_function=_link_or_copy
+    )
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. the staging directory lives on another filesystem
+        shutil.copy2(src, dst)
+
+
+def get_object_index():
+    """Return the object index of the in-progress config, parsing it on first use."""
+    global _object_index
+    if _object_index is None:
+        _object_index = ObjectIndex.load(INPROGRESS_CFG)
+    return _object_index
+
+
+def write_object_index():
+    """Write out all objects modified during this hook in one pass.
+
+    Files whose rendered content matches what is already live are not written;
+    the live file is linked back into the in-progress tree instead.  Returns the
+    paths that were actually written or removed.
+    """
+    if _object_index is None:
+        return []
+    digests = unitdata.kv().get(CONFIG_DIGESTS_KEY, {})
+    rendered = {}
+
+    def unchanged(path, content):
+        name = os.path.relpath(path, INPROGRESS_DIR)
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        rendered[name] = digest
+        return _restore_live_file(name, digests.get(name), digest)
+
+    changed = _object_index.write(skip=unchanged)
+    for path in changed:
+        name = os.path.relpath(path, INPROGRESS_DIR)
+        if os.path.exists(path):
+            _pending_digests[name] = [rendered[name], os.stat(path).st_ino]
+        else:
+            _pending_digests[name] = None
+    return changed
+
+
+def _restore_live_file(name, live_digest, digest):
+    """Link an unchanged live file back into the in-progress tree.
+
+    ``live_digest`` is the [digest, inode] pair recorded when the live file was
+    written; the inode check guards against the file having been replaced since.
+    """
+    live_path = os.path.join(MAIN_NAGIOS_DIR, name)
+    if not live_digest or live_digest[0] != digest:
+        return False
+    staged_path = os.path.join(INPROGRESS_DIR, name)
+    try:
+        if os.stat(live_path).st_ino != live_digest[1]:
+            return False
+        if os.path.exists(staged_path):
+            return os.path.samefile(live_path, staged_path)
+        os.link(live_path, staged_path)
+    except OSError:
+        return False
+    return True
+
+
+def inprogress_config_changed():
+    """Check whether the in-progress config differs from the live config.
+
+    Staged files which weren't rewritten are hardlinks to the live ones, so the
+    trees can be compared by inode without reading any file content.
+    """
+    return _config_tree_inodes(INPROGRESS_DIR) != _config_tree_inodes(MAIN_NAGIOS_DIR)
+
+
+def _config_tree_inodes(root):
+    inodes = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            # nagios.cfg is always rewritten to point at the in-progress tree
+            if os.path.relpath(path, root) != os.path.basename(MAIN_NAGIOS_CFG):
+                inodes[os.path.relpath(path, root)] = os.lstat(path).st_ino
+    return inodes
+
+
+def discard_inprogress_config():
+    if os.path.exists(INPROGRESS_DIR):
+        shutil.rmtree(INPROGRESS_DIR)
+    _pending_digests.clear()
+
+
+def _commit_config_digests():
+    """Record the digests of the files written, once their tree has gone live.
+
+    Files can also be removed without going through the object index, e.g. those
+    of departed hosts, so the digests of files missing from the live tree are
+    dropped too.
+    """
+    db = unitdata.kv()
+    digests = db.get(CONFIG_DIGESTS_KEY, {})
+    for name, digest in _pending_digests.items():
+        if digest is None:
+            digests.pop(name, None)
+        else:
+            digests[name] = digest
+    digests = {
+        name: digest
+        for name, digest in digests.items()
+        if os.path.exists(os.path.join(MAIN_NAGIOS_DIR, name))
+    }
+    db.set(CONFIG_DIGESTS_KEY, digests)
+    db.flush()
+    _pending_digests.clear()
+
+
+def forget_config_file(path):
+    """Tell the object index that a config file has been removed."""
+    if _object_index is not None:
+        _object_index.forget_file(path)
+
+
+def remove_inprogress_host_config(target_id, model_id=None):
+    """Remove a host's config file, so that it is regenerated."""
+    path = get_nagios_host_config_path(target_id, model_id)
+    if os.path.exists(path):
+        os.unlink(path)
 
 
 def _initialize_inprogress_config_files(full_rewrite=False):
@@ -514,6 +796,8 @@ def _get_all_related_config_paths():
     paths_to_remove = []
     for template in HOST_TEMPLATE, HOSTGROUP_TEMPLATE:
         paths_to_remove.extend(glob.glob(template.format("*")))
+    # Host files of the sharded layout, whichever layout is in use
+    paths_to_remove.extend(glob.glob(get_host_shard_pattern()))
     return paths_to_remove
 
 
@@ -521,14 +805,21 @@ def _get_minimal_related_config_paths():
     # Note: This also gets called via the config-changed hook, so there may not be any
     # implicit relation data; skip in this case.
     target_id = None
-    relation_data = relation_get()
+    relation_data = get_relation_data()
     if relation_data:
         target_id = relation_data.get(TARGET_ID_KEY)
     if target_id is None:
         return []
 
     hgroup_name = get_hostgroup_name(target_id)
-    checks = [(target_id, HOST_TEMPLATE)]
+    host_template = HOST_TEMPLATE
+    if host_config_layout() == "sharded":
+        # Only the shard of the unit's model and application needs to be searched
+        host_template = os.path.join(
+            get_host_shard_dir(target_id, relation_data.get(MODEL_ID_KEY)),
+            os.path.basename(HOST_TEMPLATE),
+        )
+    checks = [(target_id, host_template)]
     if hgroup_name is not None:
         checks.append((hgroup_name, HOSTGROUP_TEMPLATE))
 
@@ -573,15 +864,71 @@ def flush_inprogress_config():
     if not os.path.exists(INPROGRESS_DIR):
         return
 
-    if os.path.exists(MAIN_NAGIOS_BAK):
-        shutil.rmtree(MAIN_NAGIOS_BAK)
+    # Point the staged config at its final location before it goes live, so that
+    # swapping the directories is the only step which changes what nagios reads.
+    _replace_in_config(INPROGRESS_DIR, MAIN_NAGIOS_DIR)
+
+    # The previous config isn't kept as a backup: its unchanged files are the
+    # live ones, which upgrade-charm and the pynag helpers rewrite in place.
+    for path in MAIN_NAGIOS_BAK, MAIN_NAGIOS_PREVIOUS:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    if os.path.exists(MAIN_NAGIOS_DIR) and _exchange_paths(
+        INPROGRESS_DIR, MAIN_NAGIOS_DIR
+    ):
+        # The in-progress path now holds the previous config
+        shutil.rmtree(INPROGRESS_DIR)
+    else:
+        if os.path.exists(MAIN_NAGIOS_DIR):
+            shutil.move(MAIN_NAGIOS_DIR, MAIN_NAGIOS_PREVIOUS)
+        shutil.move(INPROGRESS_DIR, MAIN_NAGIOS_DIR)
+        if os.path.exists(MAIN_NAGIOS_PREVIOUS):
+            shutil.rmtree(MAIN_NAGIOS_PREVIOUS)
+    _commit_config_digests()
+
+
+def _exchange_paths(path_a, path_b):
+    """Atomically swap two paths using renameat2(RENAME_EXCHANGE).
 
-    if os.path.exists(MAIN_NAGIOS_DIR):
-        shutil.move(MAIN_NAGIOS_DIR, MAIN_NAGIOS_BAK)
-    shutil.move(INPROGRESS_DIR, MAIN_NAGIOS_DIR)
-    # now that directory has been changed need to update the config file to
-    # reflect the real stuff..
-    _commit_in_config(INPROGRESS_DIR, MAIN_NAGIOS_DIR)
+    Returns False if the kernel, libc or filesystem doesn't support it, in which
+    case the caller needs to fall back to a pair of renames.
+    """
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except AttributeError:
+        return False
+    result = renameat2(
+        AT_FDCWD, path_a.encode(), AT_FDCWD, path_b.encode(), RENAME_EXCHANGE
+    )
+    if result != 0:
+        log(
+            "Unable to exchange {} and {}: {}".format(
+                path_a, path_b, os.strerror(ctypes.get_errno())
+            ),
+            level="debug",
+        )
+        return False
+    return True
+
+
+def request_reload():
+    """Ask for a nagios reload, to be carried out by flush_pending_reload().
+
+    Hooks often regenerate several config files in a row, and upgrade-charm then runs
+    the monitors-relation-changed hook as well.  Rather than reloading and verifying
+    after every file, callers record the request and the first reload which follows
+    covers all of them.  The request is kept on disk so that it is shared with hooks
+    spawned as subprocesses.
+    """
+    with open(RELOAD_PENDING_FILE, "w"):
+        pass
+
+
+def flush_pending_reload():
+    """Reload nagios if a reload was requested since the last one."""
+    if os.path.exists(RELOAD_PENDING_FILE):
+        reload_nagios()
 
 
 def reload_nagios(max_attempts=30):
@@ -601,27 +948,29 @@ def reload_nagios(max_attempts=30):
 
     """
     # Current procedure:
-    # 1. Check for last reload message in the nagios log file
+    # 1. Check when nagios last (re)started its main loop
     # 2. Trigger the reload
-    # 3. Check for an updated reload message in the nagios log file. Loop a few times if
-    #    necessary.
-    # 4. If a reload message is not yet seen; try repeating steps 2 and 3 a few more
+    # 3. Check for a newer (re)start time. Loop a few times if necessary.
+    # 4. If a reload is not yet seen; try repeating steps 2 and 3 a few more
     #    times before giving up.
 
-    last_reload_message = _get_last_reload_message()
+    # Any reload picks up all config written so far, so it satisfies every pending
+    # request.  The marker is removed first so requests made meanwhile aren't lost.
+    if os.path.exists(RELOAD_PENDING_FILE):
+        os.unlink(RELOAD_PENDING_FILE)
+
+    probe, last_reload = _select_reload_probe()
     for i in range(max_attempts):
         log("Reloading nagios, attempt {}".format(i + 1), level="info")
         service_reload("nagios4")
         log("Reload signal sent to nagios", level="debug")
         reload_detected = False
         for _ in range(10):
-            new_reload_message = _get_last_reload_message()
-            reload_detected = (
-                new_reload_message and new_reload_message != last_reload_message
-            )
+            new_reload = probe()
+            reload_detected = new_reload is not None and new_reload != last_reload
             if reload_detected:
                 log(
-                    "Detected new SIGHUP message in nagios log file",
+                    "Detected nagios restart via {}".format(probe.__name__),
                     level="debug",
                 )
                 log("Nagios reload confirmed", level="info")
@@ -637,11 +986,111 @@ def reload_nagios(max_attempts=30):
         )
 
 
-def _get_last_reload_message():
-    stdout, _ = subprocess.Popen(
-        'tail -n1000 /var/log/nagios4/nagios.log | grep -e "Caught SIGHUP, restarting"',
-        shell=True,
-        stdout=subprocess.PIPE,
-    ).communicate()
-    stdout_lines = stdout.decode().splitlines()
-    return stdout_lines[-1].strip() if stdout_lines else None
+def _select_reload_probe():
+    """Pick the cheapest available way of telling when nagios last restarted.
+
+    Returns the probe and its current value.  The same probe has to be used for the
+    whole reload, as the sources differ slightly in what they timestamp.
+    """
+    for probe in (
+        _get_livestatus_program_start,
+        _get_status_dat_program_start,
+        _get_last_sighup_time,
+    ):
+        value = probe()
+        if value is not None:
+            return probe, value
+    return _get_last_sighup_time, None
+
+
+def _get_livestatus_program_start():
+    client = get_config_client(config)
+    if client is None:
+        return None
+    try:
+        return client.query("GET status\nColumns: program_start")[0][0]
+    except (LivestatusError, IndexError):
+        return None
+
+
+def _get_status_dat_program_start():
+    """Read program_start from the programstatus block at the top of status.dat."""
+    try:
+        with open(STATUS_DAT, errors="replace") as f:
+            for block_type, attributes in status_dat.iter_blocks(f):
+                if block_type == "programstatus":
+                    return int(attributes["program_start"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def _get_last_sighup_time(chunk_size=64 * 1024, max_bytes=1024 * 1024):
+    """Find the last SIGHUP message by reading the nagios log backwards."""
+    try:
+        with open(NAGIOS_LOG, "rb") as f:
+            end = position = f.seek(0, os.SEEK_END)
+            remainder = b""
+            while position > 0 and end - position < max_bytes:
+                read_size = min(chunk_size, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b"\n")
+                # Unless the start of the file was reached, the first line may be
+                # incomplete; keep it for the next chunk.
+                remainder = lines.pop(0) if position else b""
+                for line in reversed(lines):
+                    if SIGHUP_MESSAGE in line:
+                        return _log_line_timestamp(line)
+    except OSError:
+        pass
+    return None
+
+
+def _log_line_timestamp(line):
+    """Return the epoch of a "[<epoch>] message" log line, or the line itself."""
+    try:
+        return int(line[1 : line.index(b"]")])  # noqa: E203
+    except ValueError:
+        return line.strip()
+
+
+@contextlib.contextmanager
+def timed_phase(name):
+    """Add the wall time spent in the ``with`` block to the named hook phase."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        _phase_timings[name] = _phase_timings.get(name, 0) + (
+            time.monotonic() - started
+        )
+
+
+def record_hook_timings(hook_name, **extra):
+    """Log the phase timings of this hook as JSON and add them to the history.
+
+    The history keeps the last HOOK_TIMINGS_HISTORY runs in the unit's kv store,
+    where the show-hook-timings action reads it.
+    """
+    entry = dict(
+        extra,
+        hook=hook_name,
+        timestamp=int(time.time()),
+        total=round(sum(_phase_timings.values()), 3),
+        phases={name: round(secs, 3) for name, secs in _phase_timings.items()},
+    )
+    _phase_timings.clear()
+    log(json.dumps(entry, sort_keys=True))
+
+    db = unitdata.kv()
+    history = db.get(HOOK_TIMINGS_KEY, [])
+    history.append(entry)
+    db.set(HOOK_TIMINGS_KEY, history[-HOOK_TIMINGS_HISTORY:])
+    db.flush()
+    return entry
+
+
+def get_hook_timings():
+    """Return the recorded hook timings, oldest first."""
+    return unitdata.kv().get(HOOK_TIMINGS_KEY, [])
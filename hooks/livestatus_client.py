@@ -0,0 +1,158 @@
+"""Minimal client for the MK Livestatus query protocol.
+
+Reading nagios' state through livestatus avoids parsing status.dat or spawning
+systemctl from the hooks.  Connections are kept alive and pooled per address, so
+the several reads a hook makes (and the polling during a reload) share a socket,
+and query_many() pipelines a batch of queries over it in a single round trip.
+Livestatus can be reached on its unix socket, or on the TCP port xinetd exposes
+when livestatus_enable_xinetd is set.
+"""
+
+import json
+import os.path
+import socket
+
+DEFAULT_TIMEOUT = 2
+# "200 <length padded to 11 characters>\n"
+RESPONSE_HEADER_LENGTH = 16
+QUERY_HEADERS = "OutputFormat: json\nKeepAlive: on\nResponseHeader: fixed16\n"
+
+_clients = {}
+
+
+class LivestatusError(Exception):
+    """Livestatus couldn't be reached or rejected a query."""
+
+
+class LivestatusClient:
+    """A keep-alive connection to livestatus.
+
+    ``address`` is either the path of the unix socket or a (host, port) tuple.
+    The connection is opened on first use and transparently reopened once if it
+    turns out to have been closed, e.g. because nagios reloaded its modules.
+    """
+
+    def __init__(self, address, timeout=DEFAULT_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self._sock = None
+
+    def query(self, query):
+        """Run a single query and return its rows."""
+        return self.query_many([query])[0]
+
+    def query_many(self, queries):
+        """Send several queries in one write and return the rows of each.
+
+        Queries are the request lines without the output headers, which are
+        added here.
+        """
+        request = "".join(_format_query(query) for query in queries).encode()
+        # A pooled connection may have been closed since it was last used, so
+        # it gets a second chance on a fresh one
+        attempts = 2 if self._sock is not None else 1
+        for _ in range(attempts):
+            try:
+                return self._exchange(request, len(queries))
+            except OSError as e:
+                self.close()
+                error = e
+        raise LivestatusError(
+            "Unable to query livestatus at {}: {}".format(self.address, error)
+        )
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _exchange(self, request, count):
+        if self._sock is None:
+            self._sock = self._connect()
+        self._sock.sendall(request)
+        responses = []
+        for _ in range(count):
+            header = self._recv_exactly(RESPONSE_HEADER_LENGTH)
+            try:
+                status, length = int(header[:3]), int(header[4:15])
+            except ValueError:
+                self.close()
+                raise LivestatusError("Malformed livestatus response header")
+            body = self._recv_exactly(length)
+            if status != 200:
+                # Livestatus closes the connection after an error
+                self.close()
+                raise LivestatusError(
+                    "Livestatus query failed ({}): {}".format(
+                        status, body.decode(errors="replace").strip()
+                    )
+                )
+            try:
+                responses.append(json.loads(body.decode()))
+            except ValueError:
+                self.close()
+                raise LivestatusError("Malformed livestatus response")
+        return responses
+
+    def _connect(self):
+        if isinstance(self.address, tuple):
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.address)
+            except OSError:
+                sock.close()
+                raise
+        return sock
+
+    def _recv_exactly(self, size):
+        chunks = []
+        while size:
+            chunk = self._sock.recv(min(size, 65536))
+            if not chunk:
+                raise ConnectionResetError("livestatus closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+
+def _format_query(query):
+    return "{}\n{}\n".format(query.strip(), QUERY_HEADERS)
+
+
+def get_client(address):
+    """Return the pooled client for ``address``."""
+    client = _clients.get(address)
+    if client is None:
+        client = _clients[address] = LivestatusClient(address)
+    return client
+
+
+def close_clients():
+    for client in _clients.values():
+        client.close()
+    _clients.clear()
+
+
+def get_config_address(config):
+    """Work out where livestatus listens from the charm config.
+
+    The unix socket is preferred; the xinetd port on localhost is used when the
+    socket isn't visible to the hook.  Returns None if livestatus is disabled.
+    """
+    if not config("enable_livestatus"):
+        return None
+    path = config("livestatus_path")
+    if config("livestatus_enable_xinetd") and not os.path.exists(path):
+        return ("127.0.0.1", int(config("livestatus_xinetd_port")))
+    return path
+
+
+def get_config_client(config):
+    """Return the pooled client for the configured livestatus, or None."""
+    address = get_config_address(config)
+    if address is None:
+        return None
+    return get_client(address)
@@ -18,24 +18,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import glob
+import hashlib
+import json
 import os
 import re
 import sys
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.hookenv import (
     DEBUG,
     WARNING,
-    ingress_address,
     log,
-    related_units,
-    relation_get,
     relation_ids,
     status_set,
 )
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 from common import (
     HOST_PREFIX_MAX_LENGTH,
     HOST_PREFIX_MIN_LENGTH,
@@ -43,24 +49,43 @@ from common import (
     MODEL_ID_KEY,
     TARGET_ID_KEY,
     customize_service,
+    discard_inprogress_config,
     flush_inprogress_config,
+    flush_pending_reload,
+    forget_config_file,
+    get_host_shard_dir,
+    get_host_shard_pattern,
     get_model_id_sha,
+    get_nagios_host,
     get_nagios_host_config_path,
-    get_pynag_host,
-    get_pynag_service,
+    get_nagios_service,
+    get_relation_units_data,
+    host_config_layout,
+    host_config_layout_changed,
     initialize_inprogress_config,
+    inprogress_config_changed,
+    prune_check_commands,
+    record_hook_timings,
     refresh_hostgroups,
-    reload_nagios,
+    remove_empty_host_shards,
+    remove_inprogress_host_config,
+    request_reload,
+    save_host_config_layout,
+    timed_phase,
+    write_object_index,
 )
 
-
 MACHINE_ID_KEY = "machine_id"
+RELATION_SNAPSHOT_KEY = "nagios.relation-snapshot"
+MACHINE_TOPOLOGY_KEY = "nagios.machine-topology"
 REQUIRED_REL_DATA_KEYS = ["target-address", "monitors", TARGET_ID_KEY]
+# Splits "0/lxd/1/lxd/2" into the parent machine "0/lxd/1" and the container
+CONTAINER_RE = re.compile(r"^(.+)/lx[cd]/\d+$")
+# Below this many units, starting worker processes costs more than it saves
+PARALLEL_PARSE_MIN_UNITS = 200
 
 
-def _prepare_relation_data(unit, rid):
-    relation_data = relation_get(unit=unit, rid=rid)
-
+def _prepare_relation_data(unit, rid, relation_data):
     if not relation_data:
         msg = "no relation data found for unit {} in relation {} - skipping".format(
             unit, rid
@@ -75,7 +100,10 @@ def _prepare_relation_data(unit, rid):
         relation_data["monitors"] = {"monitors": {"remote": {}}}
 
     if not relation_data.get("target-address"):
-        relation_data["target-address"] = ingress_address(unit=unit, rid=rid)
+        # Same fallback as hookenv.ingress_address(), without another relation-get
+        relation_data["target-address"] = relation_data.get(
+            "ingress-address"
+        ) or relation_data.get("private-address")
 
     for key in REQUIRED_REL_DATA_KEYS:
         if not relation_data.get(key):
@@ -98,8 +126,8 @@ def _collect_relation_data():
 
     for relname in ["nagios", "monitors"]:
         for relid in relation_ids(relname):
-            for unit in related_units(relid):
-                relation_data = _prepare_relation_data(unit=unit, rid=relid)
+            for unit, relation_data in get_relation_units_data(relid).items():
+                relation_data = _prepare_relation_data(unit, relid, relation_data)
 
                 if relation_data:
                     all_relations[relid][unit] = relation_data
@@ -120,7 +148,8 @@ def main(argv, full_rewrite=False):  # noqa: C901
             relation_settings["target-address"] = argv[3]
         all_relations = {"monitors:99": {"testing/0": relation_settings}}
     else:
-        all_relations = _collect_relation_data()
+        with timed_phase("collect_relation_data"):
+            all_relations = _collect_relation_data()
 
     # Hack to work around http://pad.lv/1025478
     targets_with_addresses = set()
@@ -140,8 +169,6 @@ def main(argv, full_rewrite=False):  # noqa: C901
 
     all_relations = new_all_relations
 
-    initialize_inprogress_config(full_rewrite=full_rewrite)
-
     hosts_to_settings = defaultdict(list)
     model_ids = set()
     for units in all_relations.values():
@@ -155,7 +182,6 @@ def main(argv, full_rewrite=False):  # noqa: C901
     host_prefixes = compute_host_prefixes(model_ids)
 
     duplicate_hostnames = set()
-    all_hosts = {}
     for target_id, relation_settings_list in hosts_to_settings.items():
         related_model_ids = set(
             [
@@ -173,19 +199,7 @@ def main(argv, full_rewrite=False):  # noqa: C901
                     unique_prefix, target_id
                 )
 
-            deduped_target_id = relation_settings[TARGET_ID_KEY]
-            machine_id = relation_settings.get(MACHINE_ID_KEY)
-
-            if not machine_id or not deduped_target_id:
-                continue
-
-            # Backwards compatible hostname from machine id
-            if not model_id:
-                all_hosts[machine_id] = deduped_target_id
-            # New hostname from machine id using model id
-            else:
-                all_hosts.setdefault(model_id, {})
-                all_hosts[model_id][machine_id] = deduped_target_id
+    topology = build_machine_topology(all_relations)
 
     if duplicate_hostnames:
         message = "Duplicate host names detected: {}".format(
@@ -196,18 +210,83 @@ def main(argv, full_rewrite=False):  # noqa: C901
     else:
         status_set("active", "ready")
 
-    new_file_set = set()
-    for units in all_relations.values():
-        apply_relation_config(units, all_hosts, new_file_set)
-
-    cleanup_leftover_hosts(all_relations)
-    refresh_hostgroups()
-    flush_inprogress_config()
+    if not full_rewrite and host_config_layout_changed():
+        log("Migrating host config files to the {} layout".format(host_config_layout()))
+        full_rewrite = True
+
+    with timed_phase("initialize_inprogress_config"):
+        initialize_inprogress_config(full_rewrite=full_rewrite)
+
+    # The host shards to check for leftover files; None checks all of them
+    shard_dirs = None
+    with timed_phase("relation_delta"):
+        db = unitdata.kv()
+        snapshot = compute_relation_snapshot(all_relations)
+        if not full_rewrite:
+            # Regenerate every host whose settings or parent changed since the last
+            # run, not just the remote unit of this hook.
+            shard_dirs = set()
+            changed_hosts = compute_relation_delta(
+                db.get(RELATION_SNAPSHOT_KEY, {}), snapshot
+            )
+            previous_topology = db.get(MACHINE_TOPOLOGY_KEY)
+            if previous_topology is not None:
+                changed_hosts |= find_moved_parents(
+                    all_relations, previous_topology, topology
+                )
+            for target_id, model_id in changed_hosts:
+                remove_inprogress_host_config(target_id, model_id)
+                shard_dirs.add(get_host_shard_dir(target_id, model_id))
 
-    reload_nagios()
+    # A full rewrite renders every unit, so parse all payloads up front
+    all_monitors = {}
+    if full_rewrite:
+        with timed_phase("parse_monitors"):
+            all_monitors = parse_all_monitors(all_relations)
 
+    new_file_set = set()
+    with timed_phase("apply_relation_config"):
+        for relid, units in all_relations.items():
+            apply_relation_config(
+                units, topology, new_file_set, monitors=all_monitors.get(relid)
+            )
 
-def cleanup_leftover_hosts(all_relations):
+    with timed_phase("cleanup_leftover_hosts"):
+        cleanup_leftover_hosts(all_relations, shard_dirs)
+    with timed_phase("refresh_hostgroups"):
+        refresh_hostgroups()
+    with timed_phase("prune_check_commands"):
+        prune_check_commands()
+    with timed_phase("write_object_index"):
+        write_object_index()
+        remove_empty_host_shards()
+
+    with timed_phase("flush_inprogress_config"):
+        if not inprogress_config_changed():
+            log("Nagios config unchanged", level=DEBUG)
+            discard_inprogress_config()
+        else:
+            flush_inprogress_config()
+            request_reload()
+
+    db.set(RELATION_SNAPSHOT_KEY, snapshot)
+    db.set(MACHINE_TOPOLOGY_KEY, topology)
+    save_host_config_layout()
+    db.flush()
+
+    # Also covers reloads requested by a parent hook, e.g. upgrade-charm
+    with timed_phase("reload_nagios"):
+        flush_pending_reload()
+
+    record_hook_timings(
+        os.path.basename(argv[0]),
+        full_rewrite=full_rewrite,
+        units=sum(len(units) for units in all_relations.values()),
+        regenerated=len(new_file_set),
+    )
+
+
+def cleanup_leftover_hosts(all_relations, shard_dirs=None):
     """Cleanup leftover host files.
 
     While the charm deletes files potentially related to the immediate unit being added
@@ -219,19 +298,143 @@ def cleanup_leftover_hosts(all_relations):
     To accomodate for this, we can compare the set of generated host files present
     in the Nagios config against the set we presently intend to be present, and
     remove the extras.
+
+    With the sharded layout, only the host shards in ``shard_dirs`` are checked,
+    or all of them if it is None.
     """
     expected_paths = set()
     for units in all_relations.values():
         for relation_settings in units.values():
             target_id = relation_settings[TARGET_ID_KEY]
-            expected_path = get_nagios_host_config_path(target_id)
+            model_id = relation_settings.get(MODEL_ID_KEY)
+            expected_path = get_nagios_host_config_path(target_id, model_id)
             expected_paths.add(expected_path)
 
-    actual_paths = set(glob.glob(HOST_TEMPLATE.format("*")))
+    if host_config_layout() == "flat":
+        actual_paths = set(glob.glob(HOST_TEMPLATE.format("*")))
+    elif shard_dirs is None:
+        actual_paths = set(glob.glob(get_host_shard_pattern()))
+    else:
+        actual_paths = set()
+        for shard_dir in shard_dirs:
+            actual_paths.update(glob.glob(get_host_shard_pattern(shard_dir)))
 
     leftovers = actual_paths - expected_paths
     for path in leftovers:
         os.unlink(path)
+        forget_config_file(path)
+
+
+def compute_relation_snapshot(all_relations):
+    """Summarize the relation data each unit's generated config is rendered from.
+
+    Returns {"<relation id> <unit>": [target id, digest, model id]}, where the
+    digest covers the unit's settings.  Changes of the parent host are tracked
+    separately, by find_moved_parents().
+    """
+    snapshot = {}
+    for relid, units in all_relations.items():
+        for unit, relation_settings in units.items():
+            digest = hashlib.sha256(
+                json.dumps(relation_settings, sort_keys=True, default=str).encode()
+            ).hexdigest()
+            key = "{} {}".format(relid, unit)
+            snapshot[key] = [
+                relation_settings[TARGET_ID_KEY],
+                digest,
+                relation_settings.get(MODEL_ID_KEY),
+            ]
+    return snapshot
+
+
+def compute_relation_delta(previous, current):
+    """Return (target id, model id) of the units added, changed or departed.
+
+    The model id is None for units recorded before it was part of the snapshot.
+    """
+    added = current.keys() - previous.keys()
+    departed = previous.keys() - current.keys()
+    # The digest covers the model id, so only the target id and digest are compared
+    changed = {
+        key
+        for key in current.keys() & previous.keys()
+        if current[key][:2] != previous[key][:2]
+    }
+    log(
+        "Relation delta: {} added, {} changed, {} departed, {} unchanged".format(
+            len(added), len(changed), len(departed), len(current) - len(added | changed)
+        ),
+        level=DEBUG,
+    )
+    hosts = {_snapshot_host(current[key]) for key in added | changed}
+    # A changed unit may also have been renamed, e.g. by hostname de-duplication
+    hosts.update(_snapshot_host(previous[key]) for key in departed | changed)
+    return hosts
+
+
+def _snapshot_host(entry):
+    target_id, _, *model_id = entry
+    return target_id, model_id[0] if model_id else None
+
+
+def build_machine_topology(all_relations):
+    """Map the machines of the related units to their host names.
+
+    Returns {"<model id> <machine id>": target id}.  The model id is left empty
+    for units of older versions of charm-nrpe, which don't provide it; those are
+    only matched with each other.
+    """
+    topology = {}
+    for units in all_relations.values():
+        for relation_settings in units.values():
+            machine_id = relation_settings.get(MACHINE_ID_KEY)
+            target_id = relation_settings.get(TARGET_ID_KEY)
+            if machine_id and target_id:
+                key = _topology_key(relation_settings.get(MODEL_ID_KEY), machine_id)
+                topology[key] = target_id
+    return topology
+
+
+def get_parent_host(relation_settings, topology):
+    """Return the host name of the machine hosting a container unit, if any.
+
+    Nested containers are attached to the closest monitored machine above them:
+    the container they run in if it is monitored, otherwise its own parent.
+    """
+    machine_id = relation_settings.get(MACHINE_ID_KEY)
+    model_id = relation_settings.get(MODEL_ID_KEY)
+    while machine_id:
+        match = CONTAINER_RE.match(machine_id)
+        if not match:
+            return None
+        machine_id = match.group(1)
+        parent_host = topology.get(_topology_key(model_id, machine_id))
+        if parent_host:
+            return parent_host
+    return None
+
+
+def find_moved_parents(all_relations, previous_topology, topology):
+    """Return (target id, model id) of the units whose parent host has changed."""
+    moved = set()
+    for units in all_relations.values():
+        for relation_settings in units.values():
+            if get_parent_host(relation_settings, topology) != get_parent_host(
+                relation_settings, previous_topology
+            ):
+                moved.add(
+                    (
+                        relation_settings[TARGET_ID_KEY],
+                        relation_settings.get(MODEL_ID_KEY),
+                    )
+                )
+    if moved:
+        log("{} hosts moved to a new parent".format(len(moved)), level=DEBUG)
+    return moved
+
+
+def _topology_key(model_id, machine_id):
+    return "{} {}".format(model_id or "", machine_id)
 
 
 def compute_host_prefixes(model_ids):
@@ -253,48 +456,72 @@ def compute_host_prefixes(model_ids):
     return result
 
 
-def apply_relation_config(units, all_hosts, new_file_set):  # noqa: C901
-    for relation_settings in units.values():
+def load_monitors(monitors):
+    """Parse a unit's monitors payload, which may already be a dict."""
+    if isinstance(monitors, dict):
+        return monitors
+    return yaml.load(monitors, Loader=SafeLoader)
+
+
+def parse_all_monitors(all_relations):
+    """Parse the monitors payload of every unit, returning {relid: {unit: monitors}}.
+
+    Large payload sets are parsed in a process pool.  Results are collected in
+    submission order, so the config is rendered in the same order as a serial run.
+    """
+    keys = [(relid, unit) for relid, units in all_relations.items() for unit in units]
+    payloads = [all_relations[relid][unit]["monitors"] for relid, unit in keys]
+    parsed = None
+    workers = os.cpu_count() or 1
+    if workers > 1 and len(payloads) >= PARALLEL_PARSE_MIN_UNITS:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parsed = list(
+                    executor.map(
+                        load_monitors,
+                        payloads,
+                        chunksize=max(1, len(payloads) // (workers * 4)),
+                    )
+                )
+        except OSError as e:
+            log("Unable to start parser processes: {}".format(e), level=WARNING)
+    if parsed is None:
+        parsed = [load_monitors(payload) for payload in payloads]
+
+    all_monitors = defaultdict(dict)
+    for (relid, unit), monitors in zip(keys, parsed):
+        all_monitors[relid][unit] = monitors
+    return all_monitors
+
+
+def apply_relation_config(units, topology, new_file_set, monitors=None):  # noqa: C901
+    """Render the hosts and services of the given units.
+
+    ``monitors`` optionally holds each unit's already parsed monitors payload.
+    """
+    monitors_by_unit = monitors or {}
+    for unit, relation_settings in units.items():
         target_id = relation_settings[TARGET_ID_KEY]
-        host_config_path = get_nagios_host_config_path(target_id)
+        model_id = relation_settings.get(MODEL_ID_KEY)
+        host_config_path = get_nagios_host_config_path(target_id, model_id)
         if os.path.exists(host_config_path) and host_config_path not in new_file_set:
             # Skip updating files unrelated to the hook at hand unless they were
             # deliberately removed with the intent of them being rewritten.
             continue
         new_file_set.add(host_config_path)
 
-        monitors = relation_settings["monitors"]
-        machine_id = relation_settings.get(MACHINE_ID_KEY)
-        parent_host = None
-
-        model_id = relation_settings.get(MODEL_ID_KEY)
-
-        if machine_id:
-            container_regex = re.compile(r"(\d+)/lx[cd]/\d+")
-            if container_regex.search(machine_id):
-                parent_machine = container_regex.search(machine_id).group(1)
-
-                # Get hostname using model id
-                if model_id:
-                    model_hosts = all_hosts.get(model_id, {})
-                    parent_host = model_hosts.get(parent_machine)
-
-                # Get hostname without model id
-                # this conserves backwards compatibility with older
-                # versions of charm-nrpe that don't provide model_id
-                elif parent_machine in all_hosts:
-                    parent_host = all_hosts[parent_machine]
+        monitors = monitors_by_unit.get(unit)
+        if monitors is None:
+            monitors = load_monitors(relation_settings["monitors"])
+        parent_host = get_parent_host(relation_settings, topology)
 
         # If not set, we don't mess with it, as multiple services may feed
         # monitors in for a particular address. Generally a primary will set
         # this to its own private-address
         target_address = relation_settings.get("target-address")
 
-        if type(monitors) != dict:
-            monitors = yaml.safe_load(monitors)
-
         # Output nagios config
-        host = get_pynag_host(target_id)
+        host = get_nagios_host(target_id, model_id=model_id)
 
         if not target_address:
             raise Exception("No Target Address provied by NRPE service!")
@@ -309,7 +536,7 @@ def apply_relation_config(units, all_hosts, new_file_set):  # noqa: C901
         for mon_family, mons in monitors["monitors"]["remote"].items():
             for mon_name, mon in mons.items():
                 service_name = "%s-%s" % (target_id, mon_name)
-                service = get_pynag_service(target_id, service_name)
+                service = get_nagios_service(target_id, service_name)
                 try:
                     check_attempts = int(mon.get("max_check_attempts"))
                     service.set_attribute("max_check_attempts", check_attempts)
@@ -0,0 +1,276 @@
+"""In-memory index of Nagios object definitions.
+
+The relation hooks used to look up and create hosts, services, commands and
+hostgroups through pynag's Model, which re-parses the whole config tree on cache
+reloads and edits files one object at a time.  ObjectIndex parses the config once,
+keeps every object keyed by its short name, and writes the files that were modified
+in a single pass at the end of the hook.
+"""
+
+import os
+import tempfile
+
+SHORTNAME_ATTRIBUTES = {
+    "command": "command_name",
+    "host": "host_name",
+    "hostgroup": "hostgroup_name",
+}
+
+
+class NagiosObject:
+    """A single ``define <type> { ... }`` block.
+
+    The attribute accessors mirror the subset of pynag's ObjectDefinition API that
+    the charm uses, so the service customization helpers work with either.
+    """
+
+    def __init__(self, object_type, filename=None, attributes=None):
+        self.object_type = object_type
+        self.filename = filename
+        self.attributes = dict(attributes or {})
+        self.index = None
+        # The short name the object is indexed under, which may be stale once an
+        # attribute changes until the object is saved
+        self.indexed_name = None
+
+    def __getitem__(self, name):
+        """Return an attribute value, or None if it isn't set."""
+        return self.attributes.get(name)
+
+    def get_attribute(self, name):
+        return self.attributes.get(name)
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = str(value)
+
+    def get_filename(self):
+        return self.filename
+
+    def set_filename(self, filename):
+        self.filename = filename
+
+    def get_shortname(self):
+        if self.object_type == "service":
+            return (
+                self.attributes.get("host_name"),
+                self.attributes.get("service_description"),
+            )
+        return self.attributes.get(SHORTNAME_ATTRIBUTES.get(self.object_type))
+
+    def save(self):
+        self.index.save(self)
+
+    def delete(self):
+        self.index.delete(self)
+
+    def render(self):
+        lines = ["define {} {{\n".format(self.object_type)]
+        for name, value in self.attributes.items():
+            lines.append("\t {:<30} {}\n".format(name, value))
+        lines.append("}\n\n")
+        return "".join(lines)
+
+
+class ObjectIndex:
+    """All object definitions loaded by a nagios.cfg, keyed by short name."""
+
+    def __init__(self):
+        self._files = {}
+        self._objects = {}
+        self._dirty = set()
+        # {object type: [(key function, {group: set of short names})]}
+        self._groupings = {}
+
+    @classmethod
+    def load(cls, cfg_file):
+        """Parse every object file referenced by ``cfg_file``."""
+        index = cls()
+        for path in _object_config_paths(cfg_file):
+            for obj in parse_object_file(path):
+                index._add(obj)
+        return index
+
+    def new(self, object_type, filename):
+        """Create an object which is added to the index once it is saved."""
+        obj = NagiosObject(object_type, filename=filename)
+        obj.index = self
+        return obj
+
+    def get(self, object_type, shortname):
+        return self._objects.get(object_type, {}).get(shortname)
+
+    def get_service(self, host_name, service_description):
+        return self.get("service", (host_name, service_description))
+
+    def all(self, object_type):
+        return list(self._objects.get(object_type, {}).values())
+
+    def group(self, object_type, key):
+        """Group the short names of an object type by ``key(shortname)``.
+
+        Names for which ``key`` returns None are left out.  The returned mapping is
+        kept up to date as objects are added, renamed or removed, so the grouping
+        is only computed once per index and ``key``.
+        """
+        groupings = self._groupings.setdefault(object_type, [])
+        for grouping_key, groups in groupings:
+            if grouping_key is key:
+                return groups
+        groups = {}
+        for shortname in self._objects.get(object_type, {}):
+            _add_to_group(groups, key, shortname)
+        groupings.append((key, groups))
+        return groups
+
+    def save(self, obj):
+        """Register a new or modified object; it is written out by write()."""
+        if obj not in self._files.get(obj.filename, ()):
+            self._add(obj)
+        else:
+            # The short name may have changed since the object was indexed
+            self._unregister(obj)
+            self._register(obj)
+        self._dirty.add(obj.filename)
+
+    def delete(self, obj):
+        self._unregister(obj)
+        self._files[obj.filename].remove(obj)
+        obj.index = None
+        self._dirty.add(obj.filename)
+
+    def forget_file(self, filename):
+        """Drop the objects of a file that was removed behind the index's back."""
+        for obj in self._files.pop(filename, []):
+            self._unregister(obj)
+            obj.index = None
+        self._dirty.discard(filename)
+
+    def write(self, skip=None):
+        """Write out every modified file and return the paths written or removed.
+
+        ``skip``, if given, is called with the path and rendered content of each
+        file before it is written; when it returns True the write is skipped.
+        """
+        changed = []
+        for filename in sorted(self._dirty):
+            objects = self._files.get(filename)
+            if objects:
+                content = "".join(obj.render() for obj in objects)
+                if skip is not None and skip(filename, content):
+                    continue
+                _write_atomic(filename, content)
+            elif os.path.exists(filename):
+                os.unlink(filename)
+            else:
+                continue
+            changed.append(filename)
+        self._dirty.clear()
+        return changed
+
+    def _add(self, obj):
+        obj.index = self
+        self._files.setdefault(obj.filename, []).append(obj)
+        self._register(obj)
+
+    def _register(self, obj):
+        shortname = obj.get_shortname()
+        if isinstance(shortname, tuple) and not all(shortname) or not shortname:
+            # Templates and other unnamed definitions can't be looked up
+            return
+        # Duplicate definitions are a config error; the first one wins
+        objects = self._objects.setdefault(obj.object_type, {})
+        if objects.setdefault(shortname, obj) is obj:
+            obj.indexed_name = shortname
+            for key, groups in self._groupings.get(obj.object_type, ()):
+                _add_to_group(groups, key, shortname)
+
+    def _unregister(self, obj):
+        objects = self._objects.get(obj.object_type, {})
+        if obj.indexed_name is not None and objects.get(obj.indexed_name) is obj:
+            del objects[obj.indexed_name]
+            for key, groups in self._groupings.get(obj.object_type, ()):
+                _remove_from_group(groups, key, obj.indexed_name)
+        obj.indexed_name = None
+
+
+def _add_to_group(groups, key, shortname):
+    group = key(shortname)
+    if group is not None:
+        groups.setdefault(group, set()).add(shortname)
+
+
+def _remove_from_group(groups, key, shortname):
+    group = key(shortname)
+    members = groups.get(group)
+    if members is not None:
+        members.discard(shortname)
+        if not members:
+            del groups[group]
+
+
+def parse_object_file(path):
+    """Parse the object definitions in a Nagios config file."""
+    objects = []
+    current = None
+    with open(path) as f:
+        for line in f:
+            line = _strip_comment(line)
+            if not line:
+                continue
+            if current is None:
+                if line.startswith("define"):
+                    object_type = line.split(None, 1)[1].strip(" \t{")
+                    current = NagiosObject(object_type, filename=path)
+                continue
+            if line == "{":
+                continue
+            if line.startswith("}"):
+                objects.append(current)
+                current = None
+                continue
+            # Whitespace inside the value, e.g. in a command line, is kept
+            name, *value = line.split(None, 1)
+            current.attributes[name] = value[0] if value else ""
+    return objects
+
+
+def _strip_comment(line):
+    line = line.strip()
+    if line.startswith("#"):
+        return ""
+    # ";" starts a comment unless escaped, as in nagios' own parser
+    position = line.find(";")
+    while position != -1:
+        if position == 0 or line[position - 1] != "\\":
+            return line[:position].rstrip()
+        position = line.find(";", position + 1)
+    return line
+
+
+def _object_config_paths(cfg_file):
+    paths = []
+    with open(cfg_file) as f:
+        for line in f:
+            key, _, value = line.strip().partition("=")
+            if key == "cfg_file" and os.path.isfile(value):
+                paths.append(value)
+            elif key == "cfg_dir" and os.path.isdir(value):
+                for root, dirs, files in os.walk(value):
+                    dirs.sort()
+                    paths.extend(
+                        os.path.join(root, name)
+                        for name in sorted(files)
+                        if name.endswith(".cfg")
+                    )
+    return paths
+
+
+def _write_atomic(filename, content):
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, prefix=".", suffix=".tmp", delete=False
+    ) as f:
+        f.write(content)
+    os.chmod(f.name, 0o644)
+    os.rename(f.name, filename)
@@ -0,0 +1,166 @@
+"""Indexed reads of nagios' status.dat.
+
+status.dat holds the current state of every host and service and is rewritten by
+nagios every few seconds; on a big deployment it runs to hundreds of megabytes.
+Rather than parsing it whole for each question, the file is scanned once per
+rewrite for the byte ranges holding each host's hoststatus and servicestatus
+blocks.  That index is cached on disk next to the file's mtime and size, so a
+query about one host seeks straight to its blocks.
+"""
+
+import json
+import os
+import tempfile
+
+from charmhelpers.core.hookenv import charm_dir
+
+STATUS_DAT = "/var/lib/nagios4/status.dat"
+INDEX_FILENAME = ".status-dat-index.json"
+INDEXED_BLOCKS = (b"hoststatus", b"servicestatus")
+SERVICE_STATES = {"0": "OK", "1": "WARNING", "2": "CRITICAL", "3": "UNKNOWN"}
+
+
+def get_host_blocks(host_name, path=STATUS_DAT, index_path=None):
+    """Return the (block type, attributes) of a host's status blocks.
+
+    The host's own hoststatus block comes first, followed by its services.
+    """
+    with open(path, "rb") as f:
+        ranges = load_index(f, index_path).get(host_name, [])
+        return [
+            block
+            for start, end in ranges
+            for block in parse_blocks(_read_range(f, start, end))
+        ]
+
+
+def get_service_states(host_name=None, states=None, path=STATUS_DAT, index_path=None):
+    """Return the status of the services of a host, or of all hosts.
+
+    ``states`` optionally limits the result to services in those states, given
+    as names such as "CRITICAL".
+    """
+    with open(path, "rb") as f:
+        index = load_index(f, index_path)
+        host_names = sorted(index) if host_name is None else [host_name]
+        services = []
+        for name in host_names:
+            for start, end in index.get(name, []):
+                for block_type, attributes in parse_blocks(_read_range(f, start, end)):
+                    if block_type != "servicestatus":
+                        continue
+                    service = _service_state(attributes)
+                    if states is None or service["state"] in states:
+                        services.append(service)
+    return services
+
+
+def load_index(f, index_path=None):
+    """Return {host name: [(start, end), ...]} for the open status.dat ``f``.
+
+    The cached index is used if it was built from a file of the same mtime and
+    size; otherwise the file is scanned and the cache replaced.  ``f`` is the file
+    that is read afterwards, so a rewrite of status.dat in between doesn't
+    matter.
+    """
+    if index_path is None:
+        index_path = os.path.join(charm_dir() or "", INDEX_FILENAME)
+    stat = os.fstat(f.fileno())
+    signature = [stat.st_mtime_ns, stat.st_size]
+    try:
+        with open(index_path) as index_file:
+            cached = json.load(index_file)
+        if cached["signature"] == signature:
+            return cached["hosts"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    hosts = build_index(f)
+    _write_index(index_path, {"signature": signature, "hosts": hosts})
+    return hosts
+
+
+def build_index(f):
+    """Scan a status.dat opened in binary mode for each host's byte ranges.
+
+    The blocks of a host are consecutive, so they usually collapse into one range
+    for the hoststatus block and one for all of its services.
+    """
+    f.seek(0)
+    hosts = {}
+    offset = 0
+    block_type = block_start = host_name = previous_host = None
+    for line in f:
+        stripped = line.strip()
+        if block_type is None:
+            if stripped.endswith(b"{"):
+                block_type = stripped[:-1].strip()
+                block_start = offset
+                host_name = None
+        elif stripped == b"}":
+            end = offset + len(line)
+            if block_type not in INDEXED_BLOCKS or host_name is None:
+                previous_host = None
+            elif host_name == previous_host:
+                hosts[host_name][-1][1] = end
+            else:
+                hosts.setdefault(host_name, []).append([block_start, end])
+                previous_host = host_name
+            block_type = None
+        elif host_name is None and stripped.startswith(b"host_name="):
+            host_name = stripped[10:].decode(errors="replace")
+        offset += len(line)
+    return hosts
+
+
+def parse_blocks(data):
+    """Parse the ``type { key=value ... }`` blocks in a chunk of status.dat."""
+    return list(iter_blocks(data.decode(errors="replace").splitlines()))
+
+
+def iter_blocks(lines):
+    """Yield the (block type, attributes) of the blocks in lines of status.dat.
+
+    A block only starts outside of another one, so a value ending in "{", as
+    plugin output may, is read as a value.
+    """
+    attributes = None
+    for line in lines:
+        line = line.strip()
+        if attributes is None:
+            if line.endswith("{"):
+                block_type = line[:-1].strip()
+                attributes = {}
+        elif line == "}":
+            yield block_type, attributes
+            attributes = None
+        else:
+            key, _, value = line.partition("=")
+            attributes[key] = value
+
+
+def _service_state(attributes):
+    return {
+        "host": attributes.get("host_name"),
+        "service": attributes.get("service_description"),
+        "state": SERVICE_STATES.get(attributes.get("current_state"), "UNKNOWN"),
+        "output": attributes.get("plugin_output"),
+        "last_check": int(attributes.get("last_check") or 0),
+    }
+
+
+def _read_range(f, start, end):
+    f.seek(start)
+    return f.read(end - start)
+
+
+def _write_index(index_path, index):
+    directory = os.path.dirname(index_path) or "."
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".", suffix=".tmp", delete=False
+        ) as index_file:
+            json.dump(index, index_file, separators=(",", ":"))
+        os.rename(index_file.name, index_path)
+    except OSError:
+        # Only a cache; the next query rebuilds it
+        pass
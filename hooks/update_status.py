@@ -1,22 +1,143 @@
 #!/usr/bin/env python3
 
+import collections
 import subprocess
+
 from charmhelpers.core import hookenv
 
+from livestatus_client import LivestatusError, get_config_client
+
+import status_dat
+
 NAGIOS_SERVICE = "nagios4"
+# {block: {key: (statistic, function adding the value to it)}}
+STATUS_DAT_FIELDS = {
+    "programstatus": {
+        # The active checks run in the last 1, 5 and 15 minutes
+        "active_scheduled_host_check_stats": (
+            "checks_last_minute",
+            lambda value: int(value.split(",")[0]),
+        ),
+        "active_scheduled_service_check_stats": (
+            "checks_last_minute",
+            lambda value: int(value.split(",")[0]),
+        ),
+    },
+    "hoststatus": {"current_state": ("hosts_down", lambda value: value != "0")},
+    "servicestatus": {
+        "current_state": ("services_not_ok", lambda value: value != "0"),
+        "check_latency": ("latency", float),
+        "check_execution_time": ("execution_time", float),
+    },
+}
+STATS_QUERIES = [
+    "GET status\nColumns: host_checks_rate service_checks_rate",
+    # [[total, not up]]
+    "GET hosts\nStats: state >= 0\nStats: state != 0",
+    # [[total, not OK, average latency, average execution time]]
+    "GET services\nStats: state >= 0\nStats: state != 0\n"
+    "Stats: avg latency\nStats: avg execution_time",
+]
+
+
+def get_livestatus_stats():
+    """Read check statistics from livestatus, or None if it can't be queried."""
+    client = get_config_client(hookenv.config)
+    if client is None:
+        return None
+    try:
+        status, hosts, services = client.query_many(STATS_QUERIES)
+    except LivestatusError as e:
+        hookenv.log(str(e), level="debug")
+        return None
+    host_rate, service_rate = status[0]
+    total, not_ok, latency, execution_time = services[0]
+    return {
+        "hosts": hosts[0][0],
+        "hosts_down": hosts[0][1],
+        "services": total,
+        "services_not_ok": not_ok,
+        # The averages of no services aren't numbers
+        "latency": latency if total else 0.0,
+        "execution_time": execution_time if total else 0.0,
+        "checks_rate": host_rate + service_rate,
+    }
+
+
+def get_status_dat_stats(path=status_dat.STATUS_DAT):
+    """Compute the same statistics from status.dat, or None if it can't be read.
+
+    The check rate comes from the number of active checks nagios ran in the last
+    minute, as recorded in the programstatus block.
+    """
+    totals = collections.Counter()
+    try:
+        with open(path, errors="replace") as f:
+            for block_type, attributes in status_dat.iter_blocks(f):
+                totals[block_type] += 1
+                fields = STATUS_DAT_FIELDS.get(block_type, {})
+                for key, (statistic, add) in fields.items():
+                    if key in attributes:
+                        totals[statistic] += add(attributes[key])
+    except (OSError, ValueError) as e:
+        hookenv.log("Unable to read {}: {}".format(path, e), level="debug")
+        return None
+    services = totals["servicestatus"]
+    return {
+        "hosts": totals["hoststatus"],
+        "hosts_down": totals["hosts_down"],
+        "services": services,
+        "services_not_ok": totals["services_not_ok"],
+        "latency": totals["latency"] / services if services else 0.0,
+        "execution_time": totals["execution_time"] / services if services else 0.0,
+        "checks_rate": totals["checks_last_minute"] / 60,
+    }
+
+
+def systemctl(command):
+    return (
+        subprocess.run(["systemctl", command, NAGIOS_SERVICE], capture_output=True)
+        .stdout.decode()
+        .strip()
+    )
+
+
+def format_stats(stats):
+    return (
+        "latency {latency:.2f}s, {checks_rate:.1f} checks/s, "
+        "{hosts} hosts ({hosts_down} down), "
+        "{services} services ({services_not_ok} not OK)".format(**stats)
+    )
+
 
+def main():
+    # Livestatus only answers while nagios is running, which saves asking systemd
+    stats = get_livestatus_stats()
+    if stats is None:
+        state = systemctl("is-active")
+        if state != "active":
+            if systemctl("is-failed") == "failed":
+                hookenv.status_set("blocked", "{} has failed".format(NAGIOS_SERVICE))
+            else:
+                hookenv.status_set(
+                    "maintenance", "{} is {}".format(NAGIOS_SERVICE, state)
+                )
+            return
+        stats = get_status_dat_stats()
+    if stats is None:
+        hookenv.status_set("active", "ready")
+        return
 
-is_active = subprocess.run(
-    ["systemctl", "is-active", NAGIOS_SERVICE],
-    capture_output=True
-).stdout.decode().strip() == "active"
+    hookenv.log("Nagios check statistics: {}".format(stats), level="debug")
+    max_latency = hookenv.config("max_check_latency")
+    if max_latency and stats["latency"] > max_latency:
+        hookenv.status_set(
+            "blocked",
+            "check latency above {}s: {}".format(max_latency, format_stats(stats)),
+        )
+    else:
+        hookenv.status_set("active", "ready, {}".format(format_stats(stats)))
 
-is_failed = subprocess.run(
-    ["systemctl", "is-failed", NAGIOS_SERVICE],
-    capture_output=True
-).stdout.decode().strip() != "active"
 
-if is_active:
-    hookenv.status_set('active', 'ready')
-elif is_failed:
-    hookenv.status_set('active', 'error')
+if __name__ == "__main__":
+    main()
@@ -32,7 +32,9 @@ from jinja2 import Template
 import yaml
 
 from common import (
+    flush_pending_reload,
     reload_nagios,
+    request_reload,
     update_localhost,
     update_notification_interval,
     update_notification_options,
@@ -47,6 +49,8 @@ enable_pagerduty = hookenv.config("enable_pagerduty")
 pagerduty_key = hookenv.config("pagerduty_key")
 pagerduty_path = hookenv.config("pagerduty_path")
 notification_levels = hookenv.config("pagerduty_notification_levels")
+pagerduty_forwarder = hookenv.config("pagerduty_forwarder")
+enable_perfdata = hookenv.config("enable_perfdata")
 nagios_user = hookenv.config("nagios_user")
 nagios_group = hookenv.config("nagios_group")
 ssl_config = str(hookenv.config("ssl")).lower()
@@ -57,6 +61,9 @@ nagios_cgi_cfg = "/etc/nagios4/cgi.cfg"
 pagerduty_cfg = "/etc/nagios4/conf.d/pagerduty_nagios.cfg"
 traps_cfg = "/etc/nagios4/conf.d/traps.cfg"
 pagerduty_cron = "/etc/cron.d/nagios-pagerduty-flush"
+perfdata_cron = "/etc/cron.d/nagios-perfdata"
+pagerduty_forwarder_service = "nagios-pagerduty-forwarder"
+pagerduty_forwarder_unit = "/etc/systemd/system/nagios-pagerduty-forwarder.service"
 password = hookenv.config("password")
 ro_password = hookenv.config("ro-password")
 nagiosadmin = hookenv.config("nagiosadmin") or "nagiosadmin"
@@ -231,7 +238,10 @@ def enable_pagerduty_config():
             "pagerduty_key": pagerduty_key,
             "pagerduty_path": pagerduty_path,
             "proxy_switch": proxy_switch,
+            # The forwarder sends the events as they are queued
+            "enqueue_switch": "--no-flush" if pagerduty_forwarder else "",
             "notification_levels": notification_levels,
+            "nagios_user": nagios_user,
         }
 
         with open("hooks/templates/pagerduty_nagios_cfg.tmpl", "r") as f:
@@ -241,14 +251,10 @@ def enable_pagerduty_config():
         with open(pagerduty_cfg, "w") as f:
             f.write(t.render(template_values))
 
-        with open("hooks/templates/nagios-pagerduty-flush-cron.tmpl", "r") as f2:
-            template_def = f2.read()
-
-        t2 = Template(template_def)
-        with open(pagerduty_cron, "w") as f2:
-            f2.write(t2.render(template_values))
-
         # Ship the pagerduty_nagios.py script
+        script_changed = host.file_hash("files/pagerduty_nagios.py") != host.file_hash(
+            "/usr/local/bin/pagerduty_nagios.py"
+        )
         shutil.copy("files/pagerduty_nagios.py", "/usr/local/bin/pagerduty_nagios.py")
 
         # Create the pagerduty queue dir
@@ -260,6 +266,19 @@ def enable_pagerduty_config():
         uid = pwd.getpwnam(nagios_user).pw_uid
         gid = grp.getgrnam(nagios_group).gr_gid
         os.chown(pagerduty_path, uid, gid)
+
+        if pagerduty_forwarder:
+            if os.path.isfile(pagerduty_cron):
+                os.remove(pagerduty_cron)
+            enable_pagerduty_forwarder(template_values, script_changed)
+        else:
+            disable_pagerduty_forwarder()
+            with open("hooks/templates/nagios-pagerduty-flush-cron.tmpl", "r") as f2:
+                template_def = f2.read()
+
+            t2 = Template(template_def)
+            with open(pagerduty_cron, "w") as f2:
+                f2.write(t2.render(template_values))
     else:
         # Clean up the files if we don't want pagerduty
 
@@ -269,6 +288,8 @@ def enable_pagerduty_config():
         if os.path.isfile(pagerduty_cron):
             os.remove(pagerduty_cron)
 
+        disable_pagerduty_forwarder()
+
     # Update contacts for admin
 
     if enable_pagerduty:
@@ -278,6 +299,40 @@ def enable_pagerduty_config():
             forced_contactgroup_members.append("pagerduty")
 
 
+def enable_pagerduty_forwarder(template_values, script_changed):
+    with open("hooks/templates/nagios-pagerduty-forwarder.service.tmpl", "r") as f:
+        template_def = f.read()
+
+    t = Template(template_def)
+    unit = t.render(template_values)
+    unit_changed = True
+    if os.path.isfile(pagerduty_forwarder_unit):
+        with open(pagerduty_forwarder_unit, "r") as f:
+            unit_changed = f.read() != unit
+
+    if unit_changed:
+        with open(pagerduty_forwarder_unit, "w") as f:
+            f.write(unit)
+        subprocess.check_call(["systemctl", "daemon-reload"])
+
+    host.service("enable", pagerduty_forwarder_service)
+    if unit_changed or script_changed:
+        # Restart to pick up a new unit or a new version of the script
+        host.service_restart(pagerduty_forwarder_service)
+    else:
+        # Leave a running forwarder alone, but start it if it has stopped
+        host.service_start(pagerduty_forwarder_service)
+
+
+def disable_pagerduty_forwarder():
+    if not os.path.isfile(pagerduty_forwarder_unit):
+        return
+    host.service_stop(pagerduty_forwarder_service)
+    host.service("disable", pagerduty_forwarder_service)
+    os.remove(pagerduty_forwarder_unit)
+    subprocess.check_call(["systemctl", "daemon-reload"])
+
+
 def enable_traps_config():
     global forced_contactgroup_members
 
@@ -342,7 +397,7 @@ def update_commands():
     with open("/etc/nagios4/commands.cfg", "w") as f:
         f.write(t.render(template_values))
 
-    reload_nagios()
+    request_reload()
 
 
 def update_contacts():
@@ -416,7 +471,7 @@ def update_contacts():
     with open("/etc/nagios4/conf.d/contacts_nagios2.cfg", "w") as f:
         f.write(t.render(template_values))
 
-    reload_nagios()
+    request_reload()
 
 
 def ssl_configured():
@@ -526,8 +581,23 @@ def update_config():
         "is_container": host.is_container(),
         "service_check_timeout": hookenv.config("service_check_timeout"),
         "service_check_timeout_state": hookenv.config("service_check_timeout_state"),
+        "process_performance_data": nagios_bool(enable_perfdata),
+        "perfdata_processing_interval": hookenv.config("perfdata_processing_interval"),
     }
 
+    if enable_perfdata:
+        # Ship the performance data loader, and run it from cron rather than from
+        # nagios, which would wait for it
+        shutil.copy("files/nagios_perfdata.py", "/usr/local/bin/nagios_perfdata.py")
+        with open("hooks/templates/nagios-perfdata-cron.tmpl", "r") as f:
+            template_def = f.read()
+
+        t = Template(template_def)
+        with open(perfdata_cron, "w") as f:
+            f.write(t.render(template_values))
+    elif os.path.isfile(perfdata_cron):
+        os.remove(perfdata_cron)
+
     with open("hooks/templates/nagios-cfg.tmpl", "r") as f:
         template_def = f.read()
 
@@ -542,7 +612,7 @@ def update_config():
     with open("/etc/nagios4/conf.d/localhost_nagios2.cfg", "w") as f:
         f.write(t.render(template_values))
 
-    reload_nagios()
+    request_reload()
 
 
 def update_cgi_config():
@@ -554,7 +624,7 @@ def update_cgi_config():
     with open(nagios_cgi_cfg, "w") as f:
         f.write(t.render(template_values))
 
-    reload_nagios()
+    request_reload()
     host.service_reload("apache2")
 
 
@@ -748,3 +818,5 @@ if enable_livestatus:
 subprocess.call(["scripts/postfix_loopback_only.sh"])
 subprocess.call(["hooks/mymonitors-relation-joined"])
 subprocess.call(["hooks/monitors-relation-changed"])
+# Normally a no-op, as monitors-relation-changed performs any pending reload
+flush_pending_reload()
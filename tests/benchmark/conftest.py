@@ -0,0 +1,71 @@
+import json
+import os
+
+from charmhelpers.core import unitdata
+
+from fleet import HookEnvironment, RESULTS
+
+import pytest
+
+from startup import STARTUP_RESULTS
+
+
+@pytest.fixture
+def hook_env(tmp_path, monkeypatch):
+    monkeypatch.setattr(unitdata, "_KV", unitdata.Storage(":memory:"))
+    yield HookEnvironment(tmp_path)
+
+
+def pytest_terminal_summary(terminalreporter):
+    if RESULTS:
+        report_relation_changed(terminalreporter)
+    if STARTUP_RESULTS:
+        report_startup(terminalreporter)
+    output = os.environ.get("BENCHMARK_JSON")
+    if output:
+        with open(output, "w") as f:
+            json.dump(RESULTS + STARTUP_RESULTS, f, indent=2)
+
+
+def report_relation_changed(terminalreporter):
+    terminalreporter.section("monitors-relation-changed benchmark")
+    terminalreporter.write_line(
+        "{:>6} {:<8} {:<20} {:>9} {:>12} {:>7} {:>7}  slowest phases".format(
+            "units",
+            "layout",
+            "scenario",
+            "wall (s)",
+            "peak RSS MB",
+            "writes",
+            "reloads",
+        )
+    )
+    for result in RESULTS:
+        slowest = sorted(result["phases"].items(), key=lambda x: -x[1])[:3]
+        terminalreporter.write_line(
+            "{units:>6} {layout:<8} {scenario:<20} {wall:>9.3f} {peak_rss:>12} "
+            "{writes:>7} {reloads:>7}  {slowest}".format(
+                peak_rss=(
+                    "n/a"
+                    if result["peak_rss_mb"] is None
+                    else "{:.1f}".format(result["peak_rss_mb"])
+                ),
+                slowest=", ".join("{} {:.3f}".format(*phase) for phase in slowest),
+                **result
+            )
+        )
+
+
+def report_startup(terminalreporter):
+    terminalreporter.section("pagerduty_nagios.py startup benchmark")
+    terminalreporter.write_line(
+        "{:<20} {:>5} {:>9} {:>12}".format(
+            "scenario", "runs", "min (ms)", "median (ms)"
+        )
+    )
+    for result in STARTUP_RESULTS:
+        terminalreporter.write_line(
+            "{scenario:<20} {runs:>5} {min_ms:>9.1f} {median_ms:>12.1f}".format(
+                **result
+            )
+        )
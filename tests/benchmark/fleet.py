@@ -0,0 +1,205 @@
+"""Synthetic monitors relation data and a harness to run the hook against it."""
+
+import os
+import sys
+import time
+
+from mock import patch
+
+import yaml
+
+HOOKS = os.path.join(os.path.dirname(__file__), "..", "..", "hooks")
+sys.path.append(HOOKS)
+
+import common  # noqa: E402
+
+import monitors_relation_changed  # noqa: E402
+
+import nagios_objects  # noqa: E402
+
+CONFIG_YAML = os.path.join(os.path.dirname(__file__), "..", "..", "config.yaml")
+
+NRPE_CHECKS = [
+    "check_conntrack",
+    "check_disk_root",
+    "check_load",
+    "check_mem",
+    "check_ntp",
+    "check_swap",
+    "check_swap_activity",
+    "check_zombie_procs",
+]
+APPLICATIONS = ["ceph-osd", "nova-compute", "mysql", "rabbitmq", "keystone"]
+
+# Results of every scenario run in this session, reported at the end
+RESULTS = []
+
+
+def generate_fleet(n_units, n_models=3):
+    """Generate monitors relation data for ``n_units`` units, as {relid: {unit: ...}}.
+
+    Every model deploys the same applications, so host names collide across models
+    and get de-duplicated.  Every fourth unit runs in a LXD container, and every
+    eighth one in a container nested in another container.
+    """
+    monitors = yaml.safe_dump(
+        {
+            "monitors": {
+                "remote": {
+                    "nrpe": {
+                        name: {"command": name, "max_check_attempts": 3}
+                        for name in NRPE_CHECKS
+                    },
+                    "tcp": {"ssh": {"port": 22}},
+                }
+            }
+        }
+    )
+    fleet = {}
+    for m in range(n_models):
+        model_id = "{:08x}-0000-4000-8000-{:012x}".format(m, m)
+        units = fleet["monitors:{}".format(m)] = {}
+        for i in range(n_units // n_models + (m < n_units % n_models)):
+            if i % 8 == 7:
+                machine_id = "{}/lxd/0/lxd/1".format(i - 7)
+            elif i % 4 == 3:
+                machine_id = "{}/lxd/0".format(i - 3)
+            else:
+                machine_id = str(i)
+            address = "10.{}.{}.{}".format(m, i // 250, i % 250 + 1)
+            units["nrpe-{}/{}".format(m, i)] = {
+                "target-id": "{}-{}".format(APPLICATIONS[i % len(APPLICATIONS)], i),
+                "ingress-address": address,
+                "private-address": address,
+                "machine_id": machine_id,
+                "model_id": model_id,
+                "monitors": monitors,
+            }
+    return fleet
+
+
+class HookEnvironment:
+    """A temporary nagios config tree, with the hook tools answered from a fleet."""
+
+    def __init__(self, root):
+        self.root = str(root)
+        main_dir = os.path.join(self.root, "nagios4")
+        inprogress_dir = os.path.join(self.root, "nagios4-inprogress")
+        os.makedirs(os.path.join(main_dir, "conf.d"))
+        with open(os.path.join(main_dir, "nagios.cfg"), "w") as f:
+            f.write("cfg_dir={}\n".format(os.path.join(main_dir, "conf.d")))
+        self.paths = {
+            "MAIN_NAGIOS_DIR": main_dir,
+            "MAIN_NAGIOS_CFG": os.path.join(main_dir, "nagios.cfg"),
+            "MAIN_NAGIOS_BAK": os.path.join(self.root, "nagios4.bak"),
+            "MAIN_NAGIOS_PREVIOUS": os.path.join(self.root, "nagios4-previous"),
+            "INPROGRESS_DIR": inprogress_dir,
+            "INPROGRESS_CFG": os.path.join(inprogress_dir, "nagios.cfg"),
+            "INPROGRESS_CONF_D": os.path.join(inprogress_dir, "conf.d"),
+            "OLD_CHARM_CFG": os.path.join(inprogress_dir, "conf.d", "charm.cfg"),
+            "HOST_TEMPLATE": os.path.join(inprogress_dir, "conf.d", "juju-host_{}.cfg"),
+            "HOSTGROUP_TEMPLATE": os.path.join(
+                inprogress_dir, "conf.d", "juju-hostgroup_{}.cfg"
+            ),
+            "COMMANDS_CFG": os.path.join(inprogress_dir, "conf.d", "juju-commands.cfg"),
+            "RELOAD_PENDING_FILE": os.path.join(self.root, "reload-pending"),
+        }
+        with open(CONFIG_YAML) as f:
+            options = yaml.safe_load(f)["options"]
+        self.config = {name: option.get("default") for name, option in options.items()}
+        self.fleet = {}
+
+    def run(self, scenario, full_rewrite=False, remote=None):
+        """Run the hook once and return its measurements.
+
+        ``remote`` is the (relation id, unit) the hook runs for, if any.
+        """
+        relid, unit = remote or (None, None)
+        writes = []
+        reloads = []
+        timings = []
+
+        def write_atomic(filename, content):
+            writes.append(filename)
+            return write_atomic_orig(filename, content)
+
+        def record_hook_timings(*args, **kwargs):
+            timings.append(record_hook_timings_orig(*args, **kwargs))
+            return timings[-1]
+
+        def reload_nagios():
+            reloads.append(1)
+            os.unlink(self.paths["RELOAD_PENDING_FILE"])
+
+        write_atomic_orig = nagios_objects._write_atomic
+        record_hook_timings_orig = monitors_relation_changed.record_hook_timings
+        common._relation_data.clear()
+        with patch.multiple(common, **self.paths), patch.multiple(
+            monitors_relation_changed,
+            HOST_TEMPLATE=self.paths["HOST_TEMPLATE"],
+            log=lambda *args, **kwargs: None,
+            relation_ids=lambda name: sorted(self.fleet) if name == "monitors" else [],
+            record_hook_timings=record_hook_timings,
+            status_set=lambda *args: None,
+        ), patch.multiple(
+            common,
+            config=lambda key=None: self.config if key is None else self.config[key],
+            log=lambda *args, **kwargs: None,
+            related_units=lambda rid: list(self.fleet[rid]),
+            relation_get=self.relation_get,
+            relation_id=lambda: relid,
+            reload_nagios=reload_nagios,
+            remote_unit=lambda: unit,
+        ), patch.object(
+            nagios_objects, "_write_atomic", write_atomic
+        ):
+            peak_rss_reset = reset_peak_rss()
+            started = time.perf_counter()
+            monitors_relation_changed.main(["monitors-relation-changed"], full_rewrite)
+            wall = time.perf_counter() - started
+
+        result = {
+            "scenario": scenario,
+            "layout": "sharded" if self.config["shard_host_config"] else "flat",
+            "units": sum(len(units) for units in self.fleet.values()),
+            "wall": round(wall, 3),
+            # Of this run alone, or None where the high-water mark can't be reset
+            "peak_rss_mb": get_peak_rss_mb() if peak_rss_reset else None,
+            "writes": len(writes),
+            "reloads": len(reloads),
+            "phases": timings[-1]["phases"],
+        }
+        RESULTS.append(result)
+        return result
+
+    def relation_get(self, attribute=None, unit=None, rid=None):
+        settings = self.fleet.get(rid, {}).get(unit)
+        if settings is None:
+            return None
+        settings = dict(settings)
+        return settings if attribute is None else settings.get(attribute)
+
+
+def reset_peak_rss():
+    """Reset the high-water mark of this process' RSS; False if Linux refuses."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_rss_mb():
+    """Return VmHWM, the RSS high-water mark since the last reset_peak_rss()."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    return None
+
+
+def benchmark_sizes():
+    """Fleet sizes to benchmark; BENCHMARK_SIZES="100,1000" limits them."""
+    sizes = os.environ.get("BENCHMARK_SIZES", "100,1000,10000")
+    return [int(size) for size in sizes.split(",") if size]
@@ -0,0 +1,52 @@
+"""Time the pagerduty_nagios.py command lines run by nagios and cron."""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(
+    os.path.dirname(__file__), "..", "..", "files", "pagerduty_nagios.py"
+)
+
+# A service notification, as the notify-service-by-pagerduty command runs it
+NOTIFICATION_FIELDS = [
+    "pd_nagios_object=service",
+    "CONTACTPAGER=0123abcd",
+    "NOTIFICATIONTYPE=PROBLEM",
+    "HOSTNAME=host-1",
+    "HOSTSTATE=UP",
+    "HOSTADDRESS=10.0.0.1",
+    "SERVICEDESC=load",
+    "SERVICESTATE=CRITICAL",
+    "SERVICEOUTPUT=CRITICAL - load average: 30.00, 25.00, 20.00",
+    "SHORTDATETIME=2023-11-14 22:13:20",
+    "LONGDATETIME=Tue Nov 14 22:13:20 UTC 2023",
+]
+
+# Results of every command timed in this session, reported at the end
+STARTUP_RESULTS = []
+
+
+def time_command(scenario, args, runs):
+    """Run ``python <args>`` ``runs`` times and record its wall times."""
+    command = [sys.executable] + args
+    walls = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, check=True)
+        walls.append(time.perf_counter() - started)
+    result = {
+        "scenario": scenario,
+        "runs": runs,
+        "min_ms": round(min(walls) * 1000, 1),
+        "median_ms": round(statistics.median(walls) * 1000, 1),
+    }
+    STARTUP_RESULTS.append(result)
+    return result
+
+
+def benchmark_runs():
+    """Return how often each command is run; BENCHMARK_RUNS="10" shortens that."""
+    return int(os.environ.get("BENCHMARK_RUNS", "50"))
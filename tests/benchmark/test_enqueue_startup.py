@@ -0,0 +1,28 @@
+import sqlite3
+
+from startup import NOTIFICATION_FIELDS, SCRIPT, benchmark_runs, time_command
+
+
+def test_enqueue_startup(tmp_path):
+    queue_dir = str(tmp_path)
+    runs = benchmark_runs()
+    enqueue = [SCRIPT, "enqueue", "--no-flush", "-q", queue_dir, "-f"]
+
+    time_command("interpreter", ["-c", "pass"], runs)
+    time_command("enqueue --no-flush", enqueue + NOTIFICATION_FIELDS, runs)
+    # Any option the fast path doesn't know takes the argparse path
+    time_command(
+        "enqueue, argparse",
+        enqueue + NOTIFICATION_FIELDS + ["--workers", "4"],
+        runs,
+    )
+    # An empty queue, so this is the cost of importing the HTTP stack
+    time_command(
+        "flush, empty queue",
+        [SCRIPT, "flush", "-q", str(tmp_path / "empty"), "-a", "http://192.0.2.1/"],
+        runs,
+    )
+
+    with sqlite3.connect(str(tmp_path / "queue.db")) as connection:
+        queued = connection.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+    assert queued == 2 * runs
@@ -0,0 +1,36 @@
+from fleet import benchmark_sizes, generate_fleet
+
+import pytest
+
+
+@pytest.mark.parametrize("layout", ["flat", "sharded"])
+@pytest.mark.parametrize("n_units", benchmark_sizes())
+def test_relation_changed(hook_env, n_units, layout):
+    hook_env.config["shard_host_config"] = layout == "sharded"
+    hook_env.fleet = generate_fleet(n_units)
+    hosts = sum(len(units) for units in hook_env.fleet.values())
+
+    result = hook_env.run("full rewrite", full_rewrite=True)
+    # One file per host, plus hostgroups and check commands
+    assert result["writes"] > hosts
+    assert result["reloads"] == 1
+
+    remote = ("monitors:0", "nrpe-0/1")
+    result = hook_env.run("unchanged unit", remote=remote)
+    assert result["writes"] == 0
+    assert result["reloads"] == 0
+
+    hook_env.fleet["monitors:0"]["nrpe-0/1"]["ingress-address"] = "192.0.2.1"
+    result = hook_env.run("changed unit", remote=remote)
+    assert result["writes"] == 1
+    assert result["reloads"] == 1
+
+    # The parent of the nested containers changes its address, not its name
+    hook_env.fleet["monitors:0"]["nrpe-0/0"]["ingress-address"] = "192.0.2.2"
+    result = hook_env.run("changed parent", remote=("monitors:0", "nrpe-0/0"))
+    assert result["writes"] == 1
+    assert result["reloads"] == 1
+
+    result = hook_env.run("unchanged rewrite", full_rewrite=True)
+    assert result["writes"] == 0
+    assert result["reloads"] == 0
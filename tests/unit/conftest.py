@@ -1,5 +1,45 @@
 import os
 import sys
 
+import pytest
+
+import yaml
+
 HOOKS = os.path.join(os.path.dirname(__file__), "..", "..", "hooks")
 sys.path.append(HOOKS)
+FILES = os.path.join(os.path.dirname(__file__), "..", "..", "files")
+sys.path.append(FILES)
+CONFIG_YAML = os.path.join(os.path.dirname(__file__), "..", "..", "config.yaml")
+
+
+@pytest.fixture(autouse=True)
+def clear_hook_caches():
+    """Reset the per-hook caches in common between tests."""
+    import common
+
+    common._relation_data.clear()
+    common._phase_timings.clear()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def unit_state(monkeypatch):
+    """Give each test an empty in-memory unit kv store."""
+    from charmhelpers.core import unitdata
+
+    monkeypatch.setattr(unitdata, "_KV", unitdata.Storage(":memory:"))
+    yield unitdata._KV
+
+
+@pytest.fixture(autouse=True)
+def charm_config(monkeypatch):
+    """Answer config lookups in common with the defaults from config.yaml."""
+    import common
+
+    with open(CONFIG_YAML) as f:
+        options = yaml.safe_load(f)["options"]
+    values = {name: option.get("default") for name, option in options.items()}
+    monkeypatch.setattr(
+        common, "config", lambda key=None: values if key is None else values.get(key)
+    )
+    yield values
@@ -1,11 +1,16 @@
+import json
 import os
 
+from charmhelpers.core import unitdata
+
 from mock import patch
 
 import pytest
 
 import common
 
+import nagios_objects
+
 
 def test_check_ip():
     assert common.check_ip("1.2.3.4")
@@ -114,3 +119,296 @@ class TestInitializeInprogressConfigFileCleanup:
         for filename in filenames:
             with open(filename, "w") as _:
                 pass
+
+
+class TestInprogressConfigStaging:
+    """Test staging and flushing of the in-progress config tree."""
+
+    @pytest.mark.parametrize("exchange", [True, False])
+    @patch("common.relation_get")
+    def test_stage_and_flush(self, rget_mock, tmpdir, exchange):
+        main_dir = os.path.join(str(tmpdir), "nagios4")
+        inprogress_dir = os.path.join(str(tmpdir), "nagios4-inprogress")
+        bak_dir = os.path.join(str(tmpdir), "nagios4.bak")
+        os.makedirs(os.path.join(main_dir, "conf.d"))
+        # Left by an earlier version of the charm
+        os.makedirs(bak_dir)
+        with open(os.path.join(main_dir, "nagios.cfg"), "w") as f:
+            f.write("cfg_dir={}/conf.d\n".format(main_dir))
+        unchanged = os.path.join(main_dir, "conf.d", "juju-host_host-1.cfg")
+        with open(unchanged, "w") as f:
+            f.write("host-1\n")
+        rget_mock.return_value = None
+
+        with patch("common.MAIN_NAGIOS_DIR", main_dir), patch(
+            "common.MAIN_NAGIOS_BAK", bak_dir
+        ), patch(
+            "common.MAIN_NAGIOS_PREVIOUS", os.path.join(str(tmpdir), "nagios4-previous")
+        ), patch(
+            "common._exchange_paths",
+            wraps=common._exchange_paths if exchange else lambda *args: False,
+        ), patch(
+            "common.INPROGRESS_DIR", inprogress_dir
+        ), patch(
+            "common.INPROGRESS_CFG", os.path.join(inprogress_dir, "nagios.cfg")
+        ), patch(
+            "common.OLD_CHARM_CFG", os.path.join(inprogress_dir, "conf.d", "charm.cfg")
+        ):
+            common.initialize_inprogress_config()
+            staged = os.path.join(inprogress_dir, "conf.d", "juju-host_host-1.cfg")
+            # Unchanged files are shared with the live tree, not copied
+            assert os.path.samefile(staged, unchanged)
+            with open(os.path.join(inprogress_dir, "nagios.cfg")) as f:
+                assert f.read() == "cfg_dir={}/conf.d\n".format(inprogress_dir)
+
+            with open(
+                os.path.join(inprogress_dir, "conf.d", "juju-host_host-2.cfg"), "w"
+            ) as f:
+                f.write("host-2\n")
+            common.flush_inprogress_config()
+
+        # No previous tree is kept: it would share the live files' inodes
+        assert os.listdir(str(tmpdir)) == ["nagios4"]
+        assert os.path.exists(os.path.join(main_dir, "conf.d", "juju-host_host-2.cfg"))
+        with open(os.path.join(main_dir, "nagios.cfg")) as f:
+            assert f.read() == "cfg_dir={}/conf.d\n".format(main_dir)
+
+
+class TestWriteObjectIndex:
+    """Test that unchanged host files are neither rewritten nor reloaded."""
+
+    def test_unchanged_files_are_not_rewritten(self, tmpdir):
+        main_dir = os.path.join(str(tmpdir), "nagios4")
+        inprogress_dir = os.path.join(str(tmpdir), "nagios4-inprogress")
+        os.makedirs(os.path.join(main_dir, "conf.d"))
+        with open(os.path.join(main_dir, "nagios.cfg"), "w") as f:
+            f.write("cfg_dir={}/conf.d\n".format(main_dir))
+        db = unitdata.Storage(":memory:")
+
+        with patch("common.MAIN_NAGIOS_DIR", main_dir), patch(
+            "common.MAIN_NAGIOS_CFG", os.path.join(main_dir, "nagios.cfg")
+        ), patch(
+            "common.MAIN_NAGIOS_BAK", os.path.join(str(tmpdir), "nagios4.bak")
+        ), patch(
+            "common.MAIN_NAGIOS_PREVIOUS", os.path.join(str(tmpdir), "nagios4-previous")
+        ), patch(
+            "common.INPROGRESS_DIR", inprogress_dir
+        ), patch(
+            "common.INPROGRESS_CFG", os.path.join(inprogress_dir, "nagios.cfg")
+        ), patch(
+            "common.OLD_CHARM_CFG", os.path.join(inprogress_dir, "conf.d", "charm.cfg")
+        ), patch(
+            "common.HOST_TEMPLATE",
+            os.path.join(inprogress_dir, "conf.d", "juju-host_{}.cfg"),
+        ), patch(
+            "common.unitdata.kv", return_value=db
+        ), patch(
+            "common.relation_get", return_value=None
+        ):
+            for expect_changed in True, False:
+                common.initialize_inprogress_config(full_rewrite=True)
+                host = common.get_nagios_host("host-1")
+                host.set_attribute("address", "10.0.0.1")
+                host.save()
+                written = common.write_object_index()
+                assert bool(written) is expect_changed
+                assert common.inprogress_config_changed() is expect_changed
+                if expect_changed:
+                    common.flush_inprogress_config()
+                else:
+                    common.discard_inprogress_config()
+
+            assert os.path.exists(
+                os.path.join(main_dir, "conf.d", "juju-host_host-1.cfg")
+            )
+            assert not os.path.exists(inprogress_dir)
+            name = os.path.join("conf.d", "juju-host_host-1.cfg")
+            assert name in db.get(common.CONFIG_DIGESTS_KEY)
+
+            # A host file removed outside the object index loses its digest too
+            common.initialize_inprogress_config()
+            os.unlink(os.path.join(inprogress_dir, name))
+            common.flush_inprogress_config()
+            assert name not in db.get(common.CONFIG_DIGESTS_KEY)
+
+
+@patch("common.INPROGRESS_CONF_D", "/etc/nagios4-inprogress/conf.d")
+def test_sharded_host_config_path(charm_config):
+    assert common.get_nagios_host_config_path("app-0", "model-a") == (
+        "/etc/nagios4-inprogress/conf.d/juju-host_app-0.cfg"
+    )
+
+    charm_config["shard_host_config"] = True
+    sha_prefix = common.get_model_id_sha("model-a")[:8]
+    assert common.get_nagios_host_config_path("app-0", "model-a") == (
+        "/etc/nagios4-inprogress/conf.d/juju-hosts/model-a/app/juju-host_app-0.cfg"
+    )
+    # De-duplicated host names share the shard of their application
+    assert common.get_nagios_host_config_path(
+        "{}_app-0".format(sha_prefix), "model-a"
+    ) == (
+        "/etc/nagios4-inprogress/conf.d/juju-hosts/model-a/app/"
+        "juju-host_{}_app-0.cfg".format(sha_prefix)
+    )
+    assert common.get_host_shard_dir("app-0") == (
+        "/etc/nagios4-inprogress/conf.d/juju-hosts/default/app"
+    )
+
+
+def test_refresh_hostgroups_saves_changed_groups_only(tmpdir):
+    index = nagios_objects.ObjectIndex()
+    hostgroup_template = str(tmpdir.join("juju-hostgroup_{}.cfg"))
+    for name in "app-0", "app-1", "db-0", "web-0":
+        host = index.new("host", str(tmpdir.join("juju-host_{}.cfg".format(name))))
+        host.set_attribute("host_name", name)
+        host.save()
+    for name, members in ("app", "app-0,app-1"), ("db", "db-0"), ("old", "old-0"):
+        hgroup = index.new("hostgroup", hostgroup_template.format(name))
+        hgroup.set_attribute("hostgroup_name", name)
+        hgroup.set_attribute("notes", "#autogenerated#")
+        hgroup.set_attribute("members", members)
+        hgroup.save()
+    index.write()
+
+    with patch("common._object_index", index), patch(
+        "common.HOSTGROUP_TEMPLATE", hostgroup_template
+    ):
+        index.get("host", "app-1").delete()
+        common.refresh_hostgroups()
+
+    assert index.write() == [
+        str(tmpdir.join("juju-host_app-1.cfg")),
+        hostgroup_template.format("app"),
+        hostgroup_template.format("old"),
+        hostgroup_template.format("web"),
+    ]
+    assert index.get("hostgroup", "app")["members"] == "app-0"
+    assert index.get("hostgroup", "db")["members"] == "db-0"
+    assert index.get("hostgroup", "web")["members"] == "web-0"
+    assert index.get("hostgroup", "old") is None
+
+
+def test_check_commands_are_shared_and_pruned(tmpdir):
+    index = nagios_objects.ObjectIndex()
+    commands_cfg = str(tmpdir.join("juju-commands.cfg"))
+    with patch("common._object_index", index), patch(
+        "common._command_registry", None
+    ), patch("common.COMMANDS_CFG", commands_cfg):
+        load = common._make_check_command(["check_nrpe", "-c", "check_load"])
+        assert common._make_check_command(["check_nrpe", "-c", "check_load"]) == load
+        disk = common._make_check_command(["check_nrpe", "-c", "check_disk"])
+        assert disk != load
+        assert disk.startswith("check_nrpe_")
+        assert len(disk) == len("check_nrpe_") + common.COMMAND_HASH_LENGTH
+        assert index.write() == [commands_cfg]
+
+        service = index.new("service", str(tmpdir.join("juju-host_host-0.cfg")))
+        service.set_attribute("host_name", "host-0")
+        service.set_attribute("service_description", "host-0-load")
+        service.set_attribute("check_command", load + "!")
+        service.save()
+        common.prune_check_commands()
+
+        assert index.get("command", load) is not None
+        assert index.get("command", disk) is None
+        # A pruned command line gets the same name when it is needed again
+        assert common._make_check_command(["check_nrpe", "-c", "check_disk"]) == disk
+
+
+def test_check_command_line_is_kept_verbatim(tmpdir):
+    index = nagios_objects.ObjectIndex()
+    commands_cfg = str(tmpdir.join("juju-commands.cfg"))
+    with patch("common._object_index", index), patch(
+        "common._command_registry", None
+    ), patch("common.COMMANDS_CFG", commands_cfg):
+        names = [
+            common._make_check_command(["check_tcp", "-s", send])
+            for send in ["'a  b'", "'a b'", "'a\tb'"]
+        ]
+        index.write()
+    # Whitespace in quoted arguments is meaningful
+    assert len(set(names)) == 3
+    # and survives being read back, for the registry of the next hook
+    assert {
+        cmd["command_name"]: cmd["command_line"]
+        for cmd in nagios_objects.parse_object_file(commands_cfg)
+    } == dict(
+        zip(names, ["check_tcp -s 'a  b'", "check_tcp -s 'a b'", "check_tcp -s 'a\tb'"])
+    )
+
+
+@patch("common.time.sleep")
+@patch("common._select_reload_probe")
+@patch("common.service_reload")
+def test_pending_reloads_are_coalesced(service_reload, select_probe, sleep, tmpdir):
+    select_probe.side_effect = [(lambda: 2, 1), (lambda: 3, 2)]
+    with patch("common.RELOAD_PENDING_FILE", str(tmpdir.join("reload-pending"))):
+        common.flush_pending_reload()
+        assert service_reload.call_count == 0
+
+        for _ in range(3):
+            common.request_reload()
+        common.flush_pending_reload()
+        common.flush_pending_reload()
+        assert service_reload.call_count == 1
+
+        common.request_reload()
+        common.flush_pending_reload()
+        assert service_reload.call_count == 2
+
+
+def test_get_status_dat_program_start(tmpdir):
+    status_dat = tmpdir.join("status.dat")
+    status_dat.write(
+        "info {\n\tcreated=1700000100\n\t}\n\n"
+        "programstatus {\n\tnagios_pid=42\n\tprogram_start=1700000000\n\t}\n\n"
+        "hoststatus {\n\thost_name=host-1\n\t}\n"
+    )
+    with patch("common.STATUS_DAT", str(status_dat)):
+        assert common._get_status_dat_program_start() == 1700000000
+    with patch("common.STATUS_DAT", str(tmpdir.join("missing"))):
+        assert common._get_status_dat_program_start() is None
+
+
+def test_get_last_sighup_time(tmpdir):
+    nagios_log = tmpdir.join("nagios.log")
+    lines = ["[1700000000] Caught SIGHUP, restarting...\n"]
+    lines += [
+        "[{}] SERVICE ALERT: host-1;disk;OK\n".format(1700000001 + i)
+        for i in range(500)
+    ]
+    lines += ["[1700009999] Caught SIGHUP, restarting...\n"]
+    lines += ["[1700010000] Event loop started...\n"]
+    nagios_log.write("".join(lines))
+    with patch("common.NAGIOS_LOG", str(nagios_log)):
+        # Small chunks exercise lines spanning chunk boundaries
+        assert common._get_last_sighup_time(chunk_size=7) == 1700009999
+        assert common._get_last_sighup_time(chunk_size=64, max_bytes=64) is None
+
+
+@patch("common.log")
+def test_record_hook_timings(log):
+    with patch("time.monotonic", side_effect=[0, 1.5, 2, 2.25, 3, 3.25]):
+        with common.timed_phase("collect"):
+            pass
+        with common.timed_phase("apply"):
+            pass
+        with common.timed_phase("apply"):
+            pass
+
+    entry = common.record_hook_timings("monitors-relation-changed", units=4)
+
+    assert entry["hook"] == "monitors-relation-changed"
+    assert entry["units"] == 4
+    assert entry["phases"] == {"collect": 1.5, "apply": 0.5}
+    assert entry["total"] == 2.0
+    assert json.loads(log.call_args[0][0]) == entry
+    assert common.get_hook_timings() == [entry]
+
+    with patch.object(common, "HOOK_TIMINGS_HISTORY", 2):
+        for _ in range(2):
+            common.record_hook_timings("upgrade-charm")
+
+    history = common.get_hook_timings()
+    assert [run["hook"] for run in history] == ["upgrade-charm", "upgrade-charm"]
+    assert history[0]["phases"] == {}
@@ -0,0 +1,134 @@
+import json
+import socket
+import threading
+
+import pytest
+
+import livestatus_client
+
+
+class FakeLivestatus:
+    """Answers each query with the rows registered for its table.
+
+    Every accepted connection is closed after ``keepalive`` responses, to imitate
+    livestatus going away when nagios reloads.
+    """
+
+    def __init__(self, path, responses, keepalive=None):
+        self.responses = responses
+        self.keepalive = keepalive
+        self.connections = 0
+        self.queries = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            with conn:
+                self.handle(conn)
+
+    def handle(self, conn):
+        buffer = b""
+        answered = 0
+        while self.keepalive is None or answered < self.keepalive:
+            while b"\n\n" not in buffer:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return
+                buffer += chunk
+            query, buffer = buffer.split(b"\n\n", 1)
+            query = query.decode()
+            self.queries.append(query)
+            table = query.split("\n")[0].split()[1]
+            if table in self.responses:
+                status, body = 200, json.dumps(self.responses[table])
+            else:
+                status, body = 404, "Invalid GET request, no such table"
+            conn.sendall("{} {:>11}\n{}".format(status, len(body), body).encode())
+            answered += 1
+
+    def close(self):
+        self.server.close()
+
+
+@pytest.fixture
+def livestatus(tmp_path):
+    servers = []
+
+    def start(responses, keepalive=None):
+        server = FakeLivestatus(str(tmp_path / "live"), responses, keepalive)
+        servers.append(server)
+        return server
+
+    yield start
+    livestatus_client.close_clients()
+    for server in servers:
+        server.close()
+
+
+def test_query_many_shares_one_connection(livestatus, tmp_path):
+    server = livestatus({"status": [[1700000000]], "hosts": [[3, 1]]})
+    client = livestatus_client.get_client(str(tmp_path / "live"))
+
+    assert client.query_many(["GET status\nColumns: program_start", "GET hosts"]) == [
+        [[1700000000]],
+        [[3, 1]],
+    ]
+    assert client.query("GET hosts") == [[3, 1]]
+    assert server.connections == 1
+    assert server.queries[0] == (
+        "GET status\nColumns: program_start\n"
+        "OutputFormat: json\nKeepAlive: on\nResponseHeader: fixed16"
+    )
+
+
+def test_reconnects_closed_connection(livestatus, tmp_path):
+    server = livestatus({"status": [[1]]}, keepalive=1)
+    client = livestatus_client.get_client(str(tmp_path / "live"))
+
+    assert client.query("GET status") == [[1]]
+    assert client.query("GET status") == [[1]]
+    assert server.connections == 2
+
+
+def test_errors(livestatus, tmp_path):
+    client = livestatus_client.get_client(str(tmp_path / "live"))
+    with pytest.raises(livestatus_client.LivestatusError):
+        client.query("GET status")
+
+    livestatus({"status": [[1]]})
+    with pytest.raises(livestatus_client.LivestatusError, match="404"):
+        client.query("GET nonsense")
+    assert client.query("GET status") == [[1]]
+
+
+def test_reload_probe_uses_livestatus(livestatus, charm_config, tmp_path):
+    import common
+
+    livestatus({"status": [[1700000000]]})
+    charm_config["enable_livestatus"] = True
+    charm_config["livestatus_path"] = str(tmp_path / "live")
+
+    assert common._select_reload_probe() == (
+        common._get_livestatus_program_start,
+        1700000000,
+    )
+
+
+def test_get_config_address(charm_config, tmp_path):
+    config = charm_config.get
+    assert livestatus_client.get_config_address(config) is None
+
+    charm_config["enable_livestatus"] = True
+    charm_config["livestatus_path"] = str(tmp_path / "live")
+    assert livestatus_client.get_config_address(config) == str(tmp_path / "live")
+
+    charm_config["livestatus_enable_xinetd"] = True
+    assert livestatus_client.get_config_address(config) == ("127.0.0.1", 6557)
@@ -2,6 +2,8 @@ import os
 
 import mock
 
+import common
+
 import monitors_relation_changed
 
 
@@ -101,7 +103,172 @@ class TestCleanupLeftoverHosts:
             )
             assert all(os.path.exists(file) for file in expected_leftover_files)
 
+    def test_cleanup_leftover_hosts_in_shards(self, tmpdir, charm_config):
+        charm_config["shard_host_config"] = True
+        with mock.patch("common.INPROGRESS_CONF_D", str(tmpdir)):
+            path = common.get_nagios_host_config_path
+            kept = path("app-0", "model-a")
+            leftover = path("app-1", "model-a")
+            other_shard = path("db-1", "model-a")
+            for filename in kept, leftover, other_shard:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+            self.create_files([kept, leftover, other_shard])
+            all_relations = {
+                "monitors:1": {
+                    "nrpe/0": {
+                        monitors_relation_changed.TARGET_ID_KEY: "app-0",
+                        monitors_relation_changed.MODEL_ID_KEY: "model-a",
+                    }
+                }
+            }
+
+            monitors_relation_changed.cleanup_leftover_hosts(
+                all_relations, {common.get_host_shard_dir("app-1", "model-a")}
+            )
+            assert os.path.exists(kept)
+            assert not os.path.exists(leftover)
+            # Shards without changed units are not searched
+            assert os.path.exists(other_shard)
+
+            monitors_relation_changed.cleanup_leftover_hosts(all_relations)
+            assert not os.path.exists(other_shard)
+
     def create_files(self, filenames):
         for filename in filenames:
             with open(filename, "w") as _:
                 pass
+
+
+class TestCollectRelationData:
+    @mock.patch("common.related_units")
+    @mock.patch("common.relation_get")
+    @mock.patch("monitors_relation_changed.relation_ids")
+    def test_one_relation_get_per_unit(self, relation_ids, relation_get, units):
+        relation_ids.side_effect = lambda name: (
+            ["monitors:1"] if name == "monitors" else []
+        )
+        units.return_value = ["nrpe/0", "nrpe/1"]
+        relation_get.side_effect = lambda unit, rid: {
+            "ingress-address": "10.0.0.{}".format(unit[-1]),
+            "private-address": "192.168.0.{}".format(unit[-1]),
+            "monitors": "monitors: {remote: {}}",
+            monitors_relation_changed.TARGET_ID_KEY: unit.replace("/", "-"),
+        }
+
+        all_relations = monitors_relation_changed._collect_relation_data()
+
+        assert relation_get.call_count == 2
+        assert all_relations["monitors:1"]["nrpe/1"]["target-address"] == "10.0.0.1"
+        # The cached settings are not modified by the hook
+        assert "target-address" not in common.get_relation_data("monitors:1", "nrpe/1")
+        assert relation_get.call_count == 2
+
+
+class TestRelationDelta:
+    def relations(self, machine_ids):
+        return {
+            "monitors:1": {
+                "nrpe/{}".format(i): {
+                    monitors_relation_changed.TARGET_ID_KEY: "host-{}".format(i),
+                    monitors_relation_changed.MACHINE_ID_KEY: machine_id,
+                    "monitors": "monitors: {remote: {}}",
+                }
+                for i, machine_id in enumerate(machine_ids)
+            }
+        }
+
+    def test_unchanged(self):
+        snapshot = monitors_relation_changed.compute_relation_snapshot(
+            self.relations(["0", "1"])
+        )
+
+        assert (
+            monitors_relation_changed.compute_relation_delta(snapshot, snapshot)
+            == set()
+        )
+
+    def test_added_changed_departed(self):
+        previous = monitors_relation_changed.compute_relation_snapshot(
+            self.relations(["0", "1", "2"])
+        )
+        all_relations = self.relations(["0", "1"])
+        all_relations["monitors:1"]["nrpe/1"]["monitors"] = "monitors: {}"
+        all_relations["monitors:1"]["nrpe/3"] = {
+            monitors_relation_changed.TARGET_ID_KEY: "host-3",
+            monitors_relation_changed.MACHINE_ID_KEY: "3",
+        }
+        current = monitors_relation_changed.compute_relation_snapshot(all_relations)
+
+        delta = monitors_relation_changed.compute_relation_delta(previous, current)
+
+        assert delta == {("host-1", None), ("host-2", None), ("host-3", None)}
+
+    def test_moved_parent_marks_children_only(self):
+        all_relations = self.relations(["0", "0/lxd/1", "0/lxd/1/lxd/2", "3/lxd/0"])
+        topology = monitors_relation_changed.build_machine_topology(all_relations)
+        moved_topology = dict(topology, **{" 0/lxd/1": "renamed-host-1"})
+
+        moved = monitors_relation_changed.find_moved_parents(
+            all_relations, topology, moved_topology
+        )
+
+        assert moved == {("host-2", None)}
+
+
+class TestGetParentHost:
+    def settings(self, machine_id, model_id=None):
+        return {
+            monitors_relation_changed.MACHINE_ID_KEY: machine_id,
+            monitors_relation_changed.MODEL_ID_KEY: model_id,
+        }
+
+    def test_nested_containers(self):
+        topology = {" 0": "host-0", " 0/lxd/1": "container-1", "m 0": "other-0"}
+        get_parent_host = monitors_relation_changed.get_parent_host
+
+        assert get_parent_host(self.settings("0"), topology) is None
+        assert get_parent_host(self.settings("0/lxd/1"), topology) == "host-0"
+        assert get_parent_host(self.settings("0/lxd/1/lxd/2"), topology) == (
+            "container-1"
+        )
+        # Unmonitored containers are skipped
+        assert get_parent_host(self.settings("0/lxd/3/lxc/4"), topology) == "host-0"
+        assert get_parent_host(self.settings("0/lxd/1", "m"), topology) == "other-0"
+        assert get_parent_host(self.settings("5/lxd/1"), topology) is None
+
+
+MONITORS_TEMPLATE = "monitors: {{remote: {{nrpe: {{check_{}: x}}}}}}"
+
+
+class TestParseAllMonitors:
+    def relations(self):
+        return {
+            "monitors:{}".format(r): {
+                "nrpe/{}".format(u): {"monitors": MONITORS_TEMPLATE.format(u)}
+                for u in range(5)
+            }
+            for r in range(2)
+        }
+
+    def test_serial(self):
+        all_monitors = monitors_relation_changed.parse_all_monitors(self.relations())
+
+        assert all_monitors["monitors:1"]["nrpe/3"] == {
+            "monitors": {"remote": {"nrpe": {"check_3": "x"}}}
+        }
+
+    @mock.patch("monitors_relation_changed.PARALLEL_PARSE_MIN_UNITS", 1)
+    @mock.patch("os.cpu_count", return_value=2)
+    def test_parallel_matches_serial(self, cpu_count):
+        expected = {
+            relid: {
+                unit: monitors_relation_changed.load_monitors(settings["monitors"])
+                for unit, settings in units.items()
+            }
+            for relid, units in self.relations().items()
+        }
+
+        all_monitors = monitors_relation_changed.parse_all_monitors(self.relations())
+
+        assert all_monitors == expected
+        assert list(all_monitors["monitors:0"]) == list(expected["monitors:0"])
@@ -0,0 +1,123 @@
+import os
+
+import nagios_objects
+
+
+def write_file(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+class TestObjectIndex:
+    def setup_config(self, tmpdir):
+        conf_d = tmpdir.mkdir("conf.d")
+        cfg_file = str(tmpdir.join("nagios.cfg"))
+        commands_cfg = str(tmpdir.join("commands.cfg"))
+        write_file(
+            cfg_file,
+            "log_file=/var/log/nagios4/nagios.log\n"
+            "cfg_file={}\n"
+            "cfg_dir={}\n".format(commands_cfg, conf_d),
+        )
+        write_file(
+            commands_cfg,
+            "# A comment\n"
+            "define command{\n"
+            "    command_name    check_ssh\n"
+            "    command_line    /usr/lib/nagios/plugins/check_ssh '$HOSTADDRESS$'\n"
+            "}\n",
+        )
+        write_file(
+            str(conf_d.join("juju-host_host-1.cfg")),
+            "define host {\n"
+            "\t host_name                      host-1\n"
+            "\t address                        10.0.0.1 ; inline comment\n"
+            "}\n"
+            "\n"
+            "define service {\n"
+            "\t host_name                      host-1\n"
+            "\t service_description            host-1-disk\n"
+            "\t check_command                  check_nrpe\\;disk\n"
+            "}\n",
+        )
+        return cfg_file, str(conf_d)
+
+    def test_load(self, tmpdir):
+        cfg_file, _ = self.setup_config(tmpdir)
+        index = nagios_objects.ObjectIndex.load(cfg_file)
+
+        assert index.get("command", "check_ssh")["command_line"] == (
+            "/usr/lib/nagios/plugins/check_ssh '$HOSTADDRESS$'"
+        )
+        assert index.get("host", "host-1")["address"] == "10.0.0.1"
+        service = index.get_service("host-1", "host-1-disk")
+        assert service["check_command"] == "check_nrpe\\;disk"
+        assert index.get("host", "host-2") is None
+
+    def test_write_only_modified_files(self, tmpdir):
+        cfg_file, conf_d = self.setup_config(tmpdir)
+        commands_cfg = str(tmpdir.join("commands.cfg"))
+        commands_mtime = os.stat(commands_cfg).st_mtime_ns
+        index = nagios_objects.ObjectIndex.load(cfg_file)
+
+        host_path = os.path.join(conf_d, "juju-host_host-2.cfg")
+        host = index.new("host", host_path)
+        host.set_attribute("host_name", "host-2")
+        host.save()
+        service = index.new("service", host_path)
+        service.set_attribute("host_name", "host-2")
+        service.set_attribute("service_description", "SSH")
+        service.save()
+        index.get("host", "host-1").set_attribute("address", "10.0.0.2")
+        index.get("host", "host-1").save()
+
+        written = index.write()
+
+        assert written == sorted(
+            [host_path, os.path.join(conf_d, "juju-host_host-1.cfg")]
+        )
+        assert os.stat(commands_cfg).st_mtime_ns == commands_mtime
+        reloaded = nagios_objects.ObjectIndex.load(cfg_file)
+        assert reloaded.get("host", "host-2")["host_name"] == "host-2"
+        assert reloaded.get_service("host-2", "SSH") is not None
+        assert reloaded.get("host", "host-1")["address"] == "10.0.0.2"
+
+    def test_delete_last_object_removes_file(self, tmpdir):
+        cfg_file, conf_d = self.setup_config(tmpdir)
+        index = nagios_objects.ObjectIndex.load(cfg_file)
+
+        index.get("host", "host-1").delete()
+        index.get_service("host-1", "host-1-disk").delete()
+        index.write()
+
+        assert not os.path.exists(os.path.join(conf_d, "juju-host_host-1.cfg"))
+        assert index.get("host", "host-1") is None
+
+    def test_save_renamed_object(self, tmpdir):
+        cfg_file, _ = self.setup_config(tmpdir)
+        index = nagios_objects.ObjectIndex.load(cfg_file)
+
+        host = index.get("host", "host-1")
+        host.set_attribute("host_name", "host-3")
+        host.save()
+
+        assert index.get("host", "host-1") is None
+        assert index.get("host", "host-3") is host
+
+    def test_group_is_maintained(self, tmpdir):
+        cfg_file, conf_d = self.setup_config(tmpdir)
+        index = nagios_objects.ObjectIndex.load(cfg_file)
+
+        def key(host_name):
+            return host_name.rsplit("-", 1)[0]
+
+        groups = index.group("host", key)
+        assert groups == {"host": {"host-1"}}
+
+        host = index.new("host", os.path.join(conf_d, "juju-host_db-0.cfg"))
+        host.set_attribute("host_name", "db-0")
+        host.save()
+        index.get("host", "host-1").delete()
+
+        assert index.group("host", key) is groups
+        assert groups == {"db": {"db-0"}}
@@ -0,0 +1,65 @@
+import sqlite3
+
+import nagios_perfdata
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "perfdata,expected",
+    [
+        ("", []),
+        (
+            "load1=0.150;15.000;30.000;0; load5=0.2;;;",
+            [
+                ("load1", 0.15, "", "15.000", "30.000", 0.0, None),
+                ("load5", 0.2, "", None, None, None, None),
+            ],
+        ),
+        (
+            "'/ free'=4096MB;;;0;8192 'it''s'=5% time=1.5e-3s",
+            [
+                ("/ free", 4096.0, "MB", None, None, 0.0, 8192.0),
+                ("it's", 5.0, "%", None, None, None, None),
+                ("time", 0.0015, "s", None, None, None, None),
+            ],
+        ),
+        ("users=U;5;10", []),
+    ],
+)
+def test_parse_perfdata(perfdata, expected):
+    assert nagios_perfdata.parse_perfdata(perfdata) == expected
+
+
+def test_process(tmp_path):
+    perfdata_file = str(tmp_path / "service-perfdata")
+    store = str(tmp_path / "perfdata.db")
+    # As moved aside by the processing command
+    (tmp_path / "service-perfdata.1700000000.spool").write_text(
+        "1700000000\thost-1\tload\tOK\tload1=0.5;;;0; load5=0.4\n"
+        "1700000000\thost-1\t\tUP\trta=0.1ms;100;500;0\n"
+        "garbage\n"
+    )
+    (tmp_path / "service-perfdata.1700000060.spool").write_text(
+        "1700000060\thost-1\tload\tWARNING\tload1=7.5;;;0;\n"
+    )
+    # Still being written by nagios
+    (tmp_path / "service-perfdata").write_text(
+        "1700000090\thost-1\tload\tOK\tload1=0.1;;;0;\n"
+    )
+    nagios_perfdata.process(perfdata_file, store)
+    # Nothing new was spooled
+    nagios_perfdata.process(perfdata_file, store)
+
+    assert list(tmp_path.glob("*.spool")) == []
+    assert (tmp_path / "service-perfdata").exists()
+    with sqlite3.connect(store) as connection:
+        rows = connection.execute(
+            "SELECT host, service, label, timestamp, state, value FROM perfdata "
+            "ORDER BY service, label"
+        ).fetchall()
+    assert rows == [
+        ("host-1", "", "rta", 1700000000, "UP", 0.1),
+        ("host-1", "load", "load1", 1700000060, "WARNING", 7.5),
+        ("host-1", "load", "load5", 1700000000, "OK", 0.4),
+    ]
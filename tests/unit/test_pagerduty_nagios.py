@@ -0,0 +1,470 @@
+import argparse
+import fcntl
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qsl
+
+import pagerduty_nagios
+
+import pytest
+
+
+class FakePagerDuty(ThreadingHTTPServer):
+    """Records the events posted to it and answers with scripted responses.
+
+    ``responses`` maps a HOSTNAME to the statuses to answer its events with, in
+    turn, or "garbage" for a malformed response; other events are accepted.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakePagerDutyHandler)
+        self.events = []
+        self.connections = 0
+        self.responses = {}
+        self.requests = 0
+        self.retry_after = None
+        self.lock = threading.Lock()
+
+    @property
+    def api_base(self):
+        return "http://127.0.0.1:{}/nagios/2010-04-15".format(self.server_port)
+
+
+class FakePagerDutyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):  # noqa: N802
+        length = int(self.headers["Content-Length"])
+        event = dict(parse_qsl(self.rfile.read(length).decode()))
+        with self.server.lock:
+            self.server.requests += 1
+            statuses = self.server.responses.get(event.get("HOSTNAME"))
+            status = statuses.pop(0) if statuses else 200
+            if status == 200:
+                self.server.events.append(event)
+        if status == "garbage":
+            # Not an HTTP status line
+            self.wfile.write(b"garbage\r\n")
+            self.close_connection = True
+            return
+        body = b'{"status": "ok"}' if status == 200 else b"error"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429 and self.server.retry_after is not None:
+            self.send_header("Retry-After", self.server.retry_after)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def pagerduty():
+    server = FakePagerDuty()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def args(tmp_path, pagerduty, monkeypatch):
+    for variable in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setattr(pagerduty_nagios, "RETRY_DELAY_S", 0)
+    return argparse.Namespace(
+        api_base=pagerduty.api_base,
+        queue_dir=str(tmp_path),
+        verbose=False,
+        workers=2,
+        max_attempts=2,
+        rate=1000.0,
+        burst=10,
+    )
+
+
+def queue_event(args, **event):
+    event.setdefault("pd_nagios_object", "service")
+    event_queue = pagerduty_nagios.EventQueue(args.queue_dir)
+    event_queue.put(event)
+    event_queue.close()
+
+
+def queued_events(args):
+    event_queue = pagerduty_nagios.EventQueue(args.queue_dir)
+    try:
+        return [item.event for item in event_queue.get_batch(limit=100)]
+    finally:
+        event_queue.close()
+
+
+def test_flush_reuses_connections(args, pagerduty):
+    for i in range(20):
+        queue_event(args, HOSTNAME="host-{}".format(i % 5), SERVICEDESC="load")
+
+    assert pagerduty_nagios.flush_queue(args)
+    assert len(pagerduty.events) == 20
+    assert pagerduty.connections <= args.workers
+    assert not queued_events(args)
+
+
+def test_failed_event_holds_back_its_incident_only(args, pagerduty):
+    queue_event(args, HOSTNAME="bad", SERVICEDESC="disk", SERVICESTATE="CRITICAL")
+    queue_event(args, HOSTNAME="bad", SERVICEDESC="disk", SERVICESTATE="OK")
+    queue_event(args, HOSTNAME="good", SERVICEDESC="disk")
+    pagerduty.responses["bad"] = [503, 503]
+
+    assert not pagerduty_nagios.flush_queue(args)
+    assert [event["HOSTNAME"] for event in pagerduty.events] == ["good"]
+    assert [event["SERVICESTATE"] for event in queued_events(args)] == [
+        "CRITICAL",
+        "OK",
+    ]
+
+    # The retry of the first attempt succeeds, and the events keep their order
+    pagerduty.responses["bad"] = [503]
+    assert pagerduty_nagios.flush_queue(args)
+    assert [event.get("SERVICESTATE") for event in pagerduty.events[1:]] == [
+        "CRITICAL",
+        "OK",
+    ]
+
+
+@pytest.mark.parametrize(
+    "body,kept", [("Event object is invalid", False), ("retry later", True)]
+)
+def test_rejected_event(args, pagerduty, body, kept):
+    queue_event(args, HOSTNAME="host-1")
+    with mock.patch.object(
+        pagerduty_nagios.PagerDutyConnection, "post", return_value=(400, body, None)
+    ):
+        assert pagerduty_nagios.flush_queue(args) is not kept
+    assert bool(queued_events(args)) is kept
+
+
+def test_queue_watcher(tmp_path):
+    watcher = pagerduty_nagios.QueueWatcher(str(tmp_path))
+    try:
+        assert not watcher.wait(0.01)
+        # Flushing rewrites the lockfile, which mustn't wake the forwarder
+        (tmp_path / "lockfile").write_text("")
+        assert not watcher.wait(0.01)
+        pagerduty_nagios.EventQueue(str(tmp_path)).close()
+        assert watcher.wait(1)
+    finally:
+        watcher.close()
+
+
+def test_forwarder_metrics(args, pagerduty, tmp_path):
+    queue_event(args, HOSTNAME="host-1")
+    queue_event(args, HOSTNAME="host-2")
+    pagerduty.responses["host-2"] = [503, 503]
+    metrics = pagerduty_nagios.ForwarderMetrics()
+    pool = pagerduty_nagios.ConnectionPool(args.api_base, args.workers)
+
+    assert not pagerduty_nagios.lock_and_flush_queue(args, pool, metrics)
+    pool.close()
+    metrics.queue_depth = 1
+    metrics.write(str(tmp_path / "forwarder.prom"))
+
+    lines = (tmp_path / "forwarder.prom").read_text().splitlines()
+    assert "pagerduty_nagios_queue_depth 1" in lines
+    assert 'pagerduty_nagios_events_total{outcome="accepted"} 1' in lines
+    assert 'pagerduty_nagios_events_total{outcome="deferred"} 1' in lines
+    assert "pagerduty_nagios_send_latency_seconds_count 1" in lines
+
+
+def test_flapping_events_are_coalesced(args, pagerduty):
+    for notification_type in [
+        "PROBLEM",
+        "ACKNOWLEDGEMENT",
+        "RECOVERY",
+        "PROBLEM",
+        "RECOVERY",
+    ]:
+        queue_event(
+            args,
+            HOSTNAME="host-1",
+            SERVICEDESC="disk",
+            NOTIFICATIONTYPE=notification_type,
+        )
+    queue_event(args, HOSTNAME="host-1", SERVICEDESC="load", NOTIFICATIONTYPE="PROBLEM")
+    queue_event(
+        args,
+        HOSTNAME="host-1",
+        SERVICEDESC="load",
+        NOTIFICATIONTYPE="ACKNOWLEDGEMENT",
+    )
+
+    assert pagerduty_nagios.flush_queue(args)
+    assert sorted(
+        (event["SERVICEDESC"], event["NOTIFICATIONTYPE"]) for event in pagerduty.events
+    ) == [("disk", "RECOVERY"), ("load", "ACKNOWLEDGEMENT"), ("load", "PROBLEM")]
+    assert not queued_events(args)
+
+
+def test_coalescing_keeps_each_pagers_incident(args, pagerduty):
+    queue_event(
+        args,
+        CONTACTPAGER="pager-1",
+        HOSTNAME="host-1",
+        SERVICEDESC="disk",
+        NOTIFICATIONTYPE="PROBLEM",
+    )
+    queue_event(
+        args,
+        CONTACTPAGER="pager-2",
+        HOSTNAME="host-1",
+        SERVICEDESC="disk",
+        NOTIFICATIONTYPE="RECOVERY",
+    )
+
+    assert pagerduty_nagios.flush_queue(args)
+    assert sorted(
+        (event["CONTACTPAGER"], event["NOTIFICATIONTYPE"]) for event in pagerduty.events
+    ) == [("pager-1", "PROBLEM"), ("pager-2", "RECOVERY")]
+    assert not queued_events(args)
+
+
+def test_enqueue_fields_from_arguments(tmp_path, monkeypatch):
+    """The notification commands work without environment macros."""
+    for variable in list(os.environ):
+        if variable.startswith(("NAGIOS_", "ICINGA_")):
+            monkeypatch.delenv(variable)
+    argv = [
+        "pagerduty_nagios.py",
+        "enqueue",
+        "-q",
+        str(tmp_path),
+        "-f",
+        "pd_nagios_object=host",
+        "CONTACTPAGER=0123abcd",
+        "NOTIFICATIONTYPE=FLAPPINGSTOP",
+        "HOSTNAME=host-1",
+        "HOSTSTATE=UP",
+        "HOSTOUTPUT=PING OK - Packet loss = 0%",
+        "-f",
+        "extra=1",
+    ]
+    monkeypatch.setattr(sys, "argv", argv)
+    pagerduty_nagios.enqueue_event(pagerduty_nagios.parse_args())
+
+    args = argparse.Namespace(queue_dir=str(tmp_path))
+    assert queued_events(args) == [
+        {
+            "pd_nagios_object": "host",
+            "CONTACTPAGER": "0123abcd",
+            "NOTIFICATIONTYPE": "RECOVERY",
+            "COERCEDFROMTYPE": "FLAPPINGSTOP",
+            "HOSTNAME": "host-1",
+            "HOSTSTATE": "UP",
+            "HOSTOUTPUT": "PING OK - Packet loss = 0%",
+            "extra": "1",
+            "pd_version": "1.0",
+        }
+    ]
+
+
+def test_legacy_event_files_are_imported(args, pagerduty):
+    for name, state in [
+        ("pd_1700000010_7.txt", "OK"),
+        ("pd_1700000009_12.txt", "WARNING"),
+        ("pd_1700000009_3.txt", "CRITICAL"),
+    ]:
+        with open(os.path.join(args.queue_dir, name), "w") as f:
+            f.write(
+                "HOSTNAME=host-1\nSERVICEDESC=disk\nSERVICESTATE={}\n".format(state)
+            )
+    pagerduty.responses["host-1"] = [503, 503]
+
+    assert not pagerduty_nagios.flush_queue(args)
+    assert not pagerduty_nagios.get_queue_from_dir(args)
+    assert [event["SERVICESTATE"] for event in queued_events(args)] == [
+        "CRITICAL",
+        "WARNING",
+        "OK",
+    ]
+
+
+def test_flush_in_batches(args, pagerduty, monkeypatch):
+    monkeypatch.setattr(pagerduty_nagios, "FLUSH_BATCH_SIZE", 3)
+    for i in range(4):
+        queue_event(args, HOSTNAME="bad", SERVICEDESC="disk", SERVICESTATE=str(i))
+        queue_event(args, HOSTNAME="good-{}".format(i), SERVICEDESC="disk")
+    pagerduty.responses["bad"] = [503, 503]
+
+    assert not pagerduty_nagios.flush_queue(args)
+    assert len(pagerduty.events) == 4
+    # The deferred incident is held back in the later batches too
+    assert [event["SERVICESTATE"] for event in queued_events(args)] == [
+        "0",
+        "1",
+        "2",
+        "3",
+    ]
+
+
+NOTIFICATION_ARGV = [
+    "enqueue",
+    "--no-flush",
+    "-q",
+    "/var/lib/nagios4/pagerduty",
+    "-f",
+    "pd_nagios_object=service",
+    "CONTACTPAGER=0123abcd",
+    "NOTIFICATIONTYPE=PROBLEM",
+    "HOSTNAME=host-1",
+    "-A",
+    "--field",
+    "SERVICEOUTPUT=",
+]
+
+
+def test_parse_enqueue_args():
+    fast = pagerduty_nagios.parse_enqueue_args(NOTIFICATION_ARGV)
+    full = pagerduty_nagios.parse_args(NOTIFICATION_ARGV)
+    assert {key: getattr(full, key) for key in vars(fast)} == vars(fast)
+
+    # Anything else is left to argparse
+    for argv in [
+        ["flush"],
+        NOTIFICATION_ARGV[1:],
+        [arg for arg in NOTIFICATION_ARGV if arg != "--no-flush"],
+        NOTIFICATION_ARGV + ["--workers", "2"],
+        NOTIFICATION_ARGV + ["-f"],
+    ]:
+        assert pagerduty_nagios.parse_enqueue_args(argv) is None
+
+
+def test_enqueue_fast_path_imports(tmp_path):
+    argv = list(NOTIFICATION_ARGV)
+    argv[argv.index("-q") + 1] = str(tmp_path)
+    script = pagerduty_nagios.__file__
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", script] + argv,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    imported = {
+        line.rsplit("|", 1)[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    assert not imported & {"argparse", "http.client", "json", "logging"}
+
+    args = argparse.Namespace(queue_dir=str(tmp_path))
+    assert [event["HOSTNAME"] for event in queued_events(args)] == ["host-1"]
+
+
+def test_put_large_event(tmp_path, monkeypatch):
+    monkeypatch.setattr(pagerduty_nagios, "MAX_SQL_VARIABLES", 4)
+    args = argparse.Namespace(queue_dir=str(tmp_path))
+    queue_event(args, HOSTNAME="host-1")
+    queue_event(args, HOSTNAME="host-2", SERVICEDESC='"disk"\n')
+    assert queued_events(args) == [
+        {"pd_nagios_object": "service", "HOSTNAME": "host-1"},
+        {
+            "pd_nagios_object": "service",
+            "HOSTNAME": "host-2",
+            "SERVICEDESC": '"disk"\n',
+        },
+    ]
+
+
+def test_rate_limiter_paces_a_storm():
+    limiter = pagerduty_nagios.RateLimiter(rate=50, burst=5)
+    started = time.monotonic()
+    for _ in range(15):
+        assert limiter.acquire("key-1", 1)
+    # The burst goes at once, the rest at the rate
+    assert time.monotonic() - started >= 0.9 * 10 / 50
+    # Other keys have their own bucket
+    assert limiter._take("key-2") == 0
+    assert limiter._take("key-1") > 0
+
+
+def test_rate_limiter_backs_off():
+    limiter = pagerduty_nagios.RateLimiter(rate=1000, burst=5)
+    limiter.back_off("key-1")
+    limiter.back_off("key-1")
+    # Twice RETRY_DELAY_S, less the jitter
+    assert 0.9 <= limiter._take("key-1") <= 2
+    assert not limiter.acquire("key-1", 0.1)
+
+    limiter.back_off("key-2", retry_after=120)
+    assert limiter._take("key-2") > 110
+    limiter.succeeded("key-1")
+    assert limiter.buckets["key-1"][2] == 0
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [(None, None), ("120", 120), ("-1", 0), ("Wed, 21 Oct 2015 07:28:00 GMT", 0)],
+)
+def test_parse_retry_after(value, expected):
+    assert pagerduty_nagios.parse_retry_after(value) == expected
+
+
+def test_retry_after_is_kept_between_flushes(args, pagerduty):
+    queue_event(args, HOSTNAME="host-1", CONTACTPAGER="key-1")
+    queue_event(args, HOSTNAME="host-2", CONTACTPAGER="key-2")
+    pagerduty.responses["host-1"] = [429]
+    pagerduty.retry_after = "120"
+
+    assert not pagerduty_nagios.flush_queue(args)
+    assert [event["HOSTNAME"] for event in pagerduty.events] == ["host-2"]
+    requests = pagerduty.requests
+
+    # The integration key is still throttled, so the event isn't even tried
+    queue_event(args, HOSTNAME="host-3", CONTACTPAGER="key-1")
+    assert not pagerduty_nagios.flush_queue(args)
+    assert pagerduty.requests == requests
+    assert [event["HOSTNAME"] for event in queued_events(args)] == [
+        "host-1",
+        "host-3",
+    ]
+
+
+def test_throttled_event_is_retried(args, pagerduty):
+    queue_event(args, HOSTNAME="host-1")
+    pagerduty.responses["host-1"] = [429]
+    pagerduty.retry_after = "0"
+
+    assert pagerduty_nagios.flush_queue(args)
+    assert [event["HOSTNAME"] for event in pagerduty.events] == ["host-1"]
+
+
+def test_malformed_response_defers_its_event(args, pagerduty):
+    queue_event(args, HOSTNAME="bad", SERVICEDESC="disk")
+    queue_event(args, HOSTNAME="good", SERVICEDESC="disk")
+    pagerduty.responses["bad"] = ["garbage"] * 10
+
+    assert not pagerduty_nagios.flush_queue(args)
+    assert [event["HOSTNAME"] for event in pagerduty.events] == ["good"]
+    assert [event["HOSTNAME"] for event in queued_events(args)] == ["bad"]
+
+
+def test_enqueue_skips_a_flush_in_progress(args, pagerduty):
+    queue_event(args, HOSTNAME="host-1")
+    with open(os.path.join(args.queue_dir, "lockfile"), "w") as lockfile:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        assert pagerduty_nagios.lock_and_flush_queue(args, wait=False) is None
+        # Nor do the cron flushes
+        args.command = "flush"
+        pagerduty_nagios.run(args)
+    assert not pagerduty.events
+    assert pagerduty_nagios.lock_and_flush_queue(args, wait=False)
+    assert [event["HOSTNAME"] for event in pagerduty.events] == ["host-1"]
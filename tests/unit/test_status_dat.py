@@ -0,0 +1,104 @@
+import os
+from unittest import mock
+
+import status_dat
+
+
+def status_block(block_type, **attributes):
+    lines = ["{} {{".format(block_type)]
+    lines.extend("\t{}={}".format(key, value) for key, value in attributes.items())
+    lines.append("\t}\n\n")
+    return "\n".join(lines)
+
+
+def write_status_dat(path, states):
+    """Write a status.dat with a host per key of states and a service per state."""
+    content = status_block("info", version="4.4.6")
+    content += status_block("programstatus", program_start=1700000000)
+    for host in states:
+        content += status_block("hoststatus", host_name=host, current_state=0)
+    for host, service_states in states.items():
+        for i, state in enumerate(service_states):
+            content += status_block(
+                "servicestatus",
+                host_name=host,
+                service_description="check-{}".format(i),
+                current_state=state,
+                plugin_output="output {}".format(i),
+                last_check=1700000100,
+            )
+    content += status_block("servicecomment", host_name="host-1", comment_id=1)
+    path.write_text(content)
+
+
+def test_index_ranges(tmp_path):
+    path = tmp_path / "status.dat"
+    write_status_dat(path, {"host-1": [0, 2], "host-2": [1]})
+
+    with open(str(path), "rb") as f:
+        index = status_dat.build_index(f)
+    assert sorted(index) == ["host-1", "host-2"]
+    # The hoststatus blocks and the services of each host
+    assert [len(ranges) for ranges in index.values()] == [2, 2]
+
+    blocks = status_dat.get_host_blocks(
+        "host-1", str(path), str(tmp_path / "index.json")
+    )
+    assert [
+        (block_type, attrs.get("service_description")) for block_type, attrs in blocks
+    ] == [
+        ("hoststatus", None),
+        ("servicestatus", "check-0"),
+        ("servicestatus", "check-1"),
+    ]
+
+
+def test_get_service_states(tmp_path):
+    path = tmp_path / "status.dat"
+    index_path = str(tmp_path / "index.json")
+    write_status_dat(path, {"host-1": [0, 2], "host-2": [1, 2, 3]})
+
+    assert status_dat.get_service_states(
+        "host-1", {"CRITICAL"}, str(path), index_path
+    ) == [
+        {
+            "host": "host-1",
+            "service": "check-1",
+            "state": "CRITICAL",
+            "output": "output 1",
+            "last_check": 1700000100,
+        }
+    ]
+    services = status_dat.get_service_states(path=str(path), index_path=index_path)
+    assert [(s["host"], s["state"]) for s in services] == [
+        ("host-1", "OK"),
+        ("host-1", "CRITICAL"),
+        ("host-2", "WARNING"),
+        ("host-2", "CRITICAL"),
+        ("host-2", "UNKNOWN"),
+    ]
+    assert (
+        status_dat.get_service_states("missing", path=str(path), index_path=index_path)
+        == []
+    )
+
+
+def test_index_is_cached_by_mtime(tmp_path):
+    path = tmp_path / "status.dat"
+    index_path = str(tmp_path / "index.json")
+    write_status_dat(path, {"host-1": [0]})
+
+    with mock.patch.object(
+        status_dat, "build_index", wraps=status_dat.build_index
+    ) as build_index:
+        status_dat.get_service_states("host-1", path=str(path), index_path=index_path)
+        status_dat.get_service_states("host-1", path=str(path), index_path=index_path)
+        assert build_index.call_count == 1
+
+        write_status_dat(path, {"host-1": [2], "host-2": [0]})
+        os.utime(str(path), ns=(0, 0))
+        services = status_dat.get_service_states(
+            "host-1", path=str(path), index_path=index_path
+        )
+        assert build_index.call_count == 2
+    assert [s["state"] for s in services] == ["CRITICAL"]
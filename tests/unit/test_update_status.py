@@ -0,0 +1,117 @@
+from unittest import mock
+
+import pytest
+
+import update_status
+
+STATUS_DAT = """\
+info {
+\tversion=4.4.6
+\t}
+
+programstatus {
+\tprogram_start=1700000000
+\tactive_scheduled_host_check_stats=2,10,30
+\tactive_scheduled_service_check_stats=58,290,870
+\t}
+
+hoststatus {
+\thost_name=host-1
+\tcurrent_state=0
+\tcheck_latency=9.000
+\t}
+
+hoststatus {
+\thost_name=host-2
+\tcurrent_state=1
+\t}
+
+servicestatus {
+\thost_name=host-1
+\tservice_description=disk
+\tplugin_output=DISK OK - {
+\tcurrent_state=0
+\tcheck_latency=0.500
+\tcheck_execution_time=0.020
+\t}
+
+servicestatus {
+\thost_name=host-1
+\tservice_description=load
+\tcurrent_state=2
+\tcheck_latency=1.500
+\tcheck_execution_time=0.040
+\t}
+"""
+
+STATS = {
+    "hosts": 2,
+    "hosts_down": 1,
+    "services": 2,
+    "services_not_ok": 1,
+    "latency": 1.0,
+    "execution_time": 0.03,
+    "checks_rate": 1.0,
+}
+
+
+@pytest.fixture
+def status_set():
+    with mock.patch("charmhelpers.core.hookenv.status_set") as status_set, mock.patch(
+        "charmhelpers.core.hookenv.log"
+    ):
+        yield status_set
+
+
+def test_get_status_dat_stats(tmp_path):
+    path = tmp_path / "status.dat"
+    path.write_text(STATUS_DAT)
+
+    assert update_status.get_status_dat_stats(str(path)) == pytest.approx(STATS)
+
+
+@pytest.mark.parametrize(
+    "max_latency,expected",
+    [
+        (
+            60,
+            (
+                "active",
+                "ready, latency 1.00s, 1.0 checks/s, 2 hosts (1 down), "
+                "2 services (1 not OK)",
+            ),
+        ),
+        (
+            0.5,
+            (
+                "blocked",
+                "check latency above 0.5s: latency 1.00s, 1.0 checks/s, "
+                "2 hosts (1 down), 2 services (1 not OK)",
+            ),
+        ),
+    ],
+)
+def test_latency_threshold(charm_config, status_set, max_latency, expected):
+    charm_config["max_check_latency"] = max_latency
+    with mock.patch.object(
+        update_status, "get_livestatus_stats", return_value=STATS
+    ), mock.patch("charmhelpers.core.hookenv.config", charm_config.get):
+        update_status.main()
+
+    status_set.assert_called_once_with(*expected)
+
+
+@pytest.mark.parametrize(
+    "states,expected",
+    [
+        (["failed", "failed"], ("blocked", "nagios4 has failed")),
+        (["inactive", "inactive"], ("maintenance", "nagios4 is inactive")),
+    ],
+)
+def test_service_not_running(status_set, states, expected):
+    with mock.patch.object(
+        update_status, "get_livestatus_stats", return_value=None
+    ), mock.patch.object(update_status, "systemctl", side_effect=states):
+        update_status.main()
+
+    status_set.assert_called_once_with(*expected)